@@ -7,65 +7,67 @@ My task in this script has two steps:
     the unexpected street types to the appropriate ones in the expected list.
 - write the update_name function, to actually fix the street name.
     The function takes a string with street name as an argument and should return the fixed name
+
+cached_audit() saves results of audit() next to the osm file and reuses them while the file and the audit rules
+are unchanged, so trying another mapping does not parse the file again.
 Usage:
 >>> python audit.py 
+>>> import audit
+>>> audit.preview_mapping('shanghai_china.osm', dict(audit.mapping, Hwy="Highway"))
 """
 import xml.etree.cElementTree as ET
 from collections import defaultdict
-import re
+import codecs
+import hashlib
+import json
+import os
 import pprint
+import cleaning
+import osmstream
+import rules
 
 OSMFILE = "shanghai_china.osm"
-street_type_re = re.compile(r'(\b\S+lu.*|\b\S+\.?$)', re.IGNORECASE) # Note that "lu" in Chinese PingYin means English word road
-postcode_re = re.compile(r'^\d{6}$') # Valid postcode should only contains 6 continual digits
-
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons", u"路"] # "路" means road in Chinese
-
-mapping = { "St.": "Street",
-            "St": "Street",
-            "Ave": "Avenue",
-            "Rd.": "Road",
-            "Rd": "Road",
-            "Raod": "Road",
-            "road": "Road",
-            "rd": "Road",
-            "Lu": "Road",
-            "lu": "Road",
-            "street": "Street",
-            "avenue": "Avenue"
-            }
+cleaning_rules = rules.get_rules() # Same rules as data.py, loaded from cleaning_rules.json
+street_type_re = cleaning_rules.street_type_re # Note that "lu" in Chinese PingYin means English word road
+expected = cleaning_rules.expected # "路" means road in Chinese
+mapping = cleaning_rules.mapping # Change it in cleaning_rules.json
+CITY_KEYS = set(cleaning_rules.keys_of("city"))
+POSTCODE_KEYS = set(cleaning_rules.keys_of("postcode"))
+PHONE_KEYS = set(cleaning_rules.keys_of("phone"))
+STREET_KEYS = set(cleaning_rules.keys_of("street"))
+CACHE_VERSION = 1 # Change it when audit_element() finds other things
+CACHE_SUFFIX = ".audit-cache.json"
+HASH_CHUNK = 1 << 20
 
 def is_address_city(elem):
     """
     Check whether element contains city info.
     """
-    return elem.attrib['k'] == "addr:city"
+    return elem.attrib['k'] in CITY_KEYS
 
 def is_address_shanghai(elem):
     """
     If element contains city info, check whether it is Shanghai?
     """
-    city = elem.attrib['v']
-    return (city == "Shanghai") or (city == "shanghai") or (city == u"上海") or (city == u"上海市") # Last two is Chinese version of Shanghai
+    return cleaning_rules.is_region_city(elem.attrib['v'])
 
 def is_address_postcode(elem):
     """
     Check whether element contains postcode info.
     """
-    return (elem.attrib['k'] == "addr:postcode")
+    return elem.attrib['k'] in POSTCODE_KEYS
 
 def is_valid_postcode(elem):
     """
     If element contains postcode, check whether it is in valid format?
     """
-    return postcode_re.search(elem.attrib['v'])
+    return cleaning_rules.postcode_re.search(elem.attrib['v'])
 
 def is_phone_number(elem):
     """
     Check whether element contains phone info.
     """
-    return (elem.attrib['k'] == "contact:phone")
+    return elem.attrib['k'] in PHONE_KEYS
 
 def audit_phone_format(phone, phoneDict):
     """
@@ -78,18 +80,14 @@ def audit_phone_format(phone, phoneDict):
     Returns:
         None
     """
-    phoneLen = len(phone)
-    tmp = ""
-    for i in range(0, phoneLen):
-        if phone[i].isdigit():
-            tmp = tmp + phone[i]
-    phoneDict[phone] = tmp[-11:]
+    if phone not in phoneDict: # Phone numbers repeat a lot, format every one once
+        phoneDict[phone] = cleaning.phone_digits(phone, cleaning_rules.phone_digits)
 
 def is_street_name(elem):
     """
     Check whether element contains street info.
     """
-    return (elem.attrib['k'] == "addr:street")
+    return elem.attrib['k'] in STREET_KEYS
 
 def audit_street_type(street_types, street_name):
     """
@@ -109,6 +107,28 @@ def audit_street_type(street_types, street_name):
             street_types[street_type].add(street_name)
 
 
+def audit_element(elem, street_types, phone_dict, not_in_shanghai, not_valid_postcode):
+    """
+    Audit all sub tags of one "node" or "way" element, add findings to given containers.
+    Used by audit() and by data.process_map() when auditing while converting.
+
+    Args:
+        param_1(element): complete "node" or "way" element (at its "end" event)
+        param_2-5: containers returned by audit(), updated in place
+    Returns:
+        None
+    """
+    for tag in elem.iter("tag"):
+        if is_street_name(tag):
+            audit_street_type(street_types, tag.attrib['v'])
+        elif is_phone_number(tag):
+            audit_phone_format(tag.attrib['v'], phone_dict)
+        elif is_address_postcode(tag) and not is_valid_postcode(tag):
+            not_valid_postcode.add(tag)
+        elif is_address_city(tag) and not is_address_shanghai(tag):
+            not_in_shanghai.add(tag.attrib['v'])
+
+
 def audit(osmfile):
     """
     Audit xml file. It contains following steps:
@@ -118,39 +138,121 @@ def audit(osmfile):
     4) Audit city to extract all not in shanghai cities;
 
     Args:
-        param_1(string): target xml file name
+        param_1(string): target xml (or PBF) file name
     Returns:
         street_types => a dictionary mapping old unformatted street name to unified formatted street name
         phone_dict => a dictionary mapping old unformatted phone number to unified formatted phone number
         not_in_shanghai => a set contains all tags whose city is not in Shanghai
         not_valid_postcode => a set contains all tags whose postcode is not valid 
     """
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
     phone_dict = defaultdict(set)
     not_in_shanghai = set()
     not_valid_postcode = set()
     count = 0
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    for event, elem in osmstream.iterparse_stream(osmfile): # Sub tags are only all parsed at "end" event
         if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-                elif is_phone_number(tag):
-                    audit_phone_format(tag.attrib['v'], phone_dict)
-                elif is_address_postcode(tag) and not is_valid_postcode(tag):
-                    not_valid_postcode.add(tag)
-                elif is_address_city(tag) and not is_address_shanghai(tag):
-                    print tag.attrib['v'] # Test whether it is right to omit this record, uncomment to avoid output
-                    not_in_shanghai.add(tag.attrib['v'])
+            audit_element(elem, street_types, phone_dict, not_in_shanghai, not_valid_postcode)
             count += 1
             # Uncomment following two lines to show progress
             # if (count % 10000) == 0:
             #     print "Audit to record #{}".format(count)
-    osm_file.close()
     return street_types, phone_dict, not_in_shanghai, not_valid_postcode
 
 
+def file_fingerprint(filename, content_hash = True):
+    """
+    Returns:
+        dictionary: "size", "mtime" and "sha1" (of the content, only if content_hash) of a file
+    """
+    stat = os.stat(filename)
+    rst = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), ""):
+                sha1.update(chunk)
+        rst["sha1"] = sha1.hexdigest()
+    return rst
+
+
+def rules_version():
+    """
+    Hash of the rules which audit_element() depends on. Mapping is not one of them, it is only used
+    by update_name() on audit results.
+    """
+    audit_rules = [CACHE_VERSION, street_type_re.pattern, sorted(expected), cleaning_rules.postcode_re.pattern,
+                   sorted(cleaning_rules.cities), cleaning_rules.phone_digits, sorted(CITY_KEYS),
+                   sorted(POSTCODE_KEYS), sorted(PHONE_KEYS), sorted(STREET_KEYS)]
+    return hashlib.sha1(json.dumps(audit_rules, sort_keys=True)).hexdigest()
+
+
+def _tag(key, value):
+    return ET.Element("tag", {"k": key, "v": value})
+
+
+def cached_audit(osmfile, cache_file = None):
+    """
+    Same as audit(), results are saved to a cache file and loaded from it while the osm file and the audit rules
+    are unchanged. The file is only hashed again when its size or modification time changed, so a touched or
+    copied file is not audited again.
+
+    Args:
+        param_1(string): target xml (or PBF) file name
+        param_2(string): cache file name, default osm file name followed by CACHE_SUFFIX
+    Returns:
+        same as audit()
+    """
+    if cache_file is None:
+        cache_file = osmfile + CACHE_SUFFIX
+    version = rules_version()
+    fingerprint = file_fingerprint(osmfile, content_hash=False)
+    cache = None
+    if os.path.exists(cache_file):
+        cache = rules.load_json(cache_file)
+        if cache["rules_version"] != version:
+            cache = None
+        elif cache["size"] != fingerprint["size"] or cache["mtime"] != fingerprint["mtime"]:
+            fingerprint = file_fingerprint(osmfile)
+            if cache["size"] != fingerprint["size"] or cache["sha1"] != fingerprint["sha1"]:
+                cache = None
+            else: # Same content, remember the new modification time
+                cache["mtime"] = fingerprint["mtime"]
+                _write_cache(cache, cache_file)
+    if cache is not None:
+        street_types = defaultdict(set, ((st_type, set(names))
+                                         for st_type, names in cache["street_types"].iteritems()))
+        phone_dict = defaultdict(set, cache["phones"])
+        not_valid_postcode = set(_tag(key, value) for key, value in cache["not_valid_postcode"])
+        return street_types, phone_dict, set(cache["not_in_shanghai"]), not_valid_postcode
+    if "sha1" not in fingerprint:
+        fingerprint = file_fingerprint(osmfile)
+    street_types, phone_dict, not_in_shanghai, not_valid_postcode = audit(osmfile)
+    cache = dict(fingerprint, rules_version=version,
+                 street_types=dict((st_type, sorted(names)) for st_type, names in street_types.iteritems()),
+                 phones=dict(phone_dict), not_in_shanghai=sorted(not_in_shanghai),
+                 not_valid_postcode=sorted((tag.attrib['k'], tag.attrib['v']) for tag in not_valid_postcode))
+    _write_cache(cache, cache_file)
+    return street_types, phone_dict, not_in_shanghai, not_valid_postcode
+
+
+def _write_cache(cache, cache_file):
+    with open(cache_file + ".tmp", "w") as fo:
+        fo.write(json.dumps(cache, sort_keys=True))
+    os.rename(cache_file + ".tmp", cache_file) # A crash while writing leaves no half written cache
+
+
+def preview_mapping(osmfile, new_mapping):
+    """
+    Show how street names of a file would be updated with another mapping, from cached_audit() results.
+
+    Returns:
+        dictionary: Keys are audited street names, values are their names after update_name()
+    """
+    street_types = cached_audit(osmfile)[0]
+    return dict((name, update_name(name, new_mapping)) for names in street_types.itervalues() for name in names)
+
+
 def update_name(name, mapping):
     """
     Update an unformatted street name to a unified formatted ones using a given mapping
@@ -162,20 +264,66 @@ def update_name(name, mapping):
     Returns:
         string: Formatted new street name of given old street name
     """
-    betterName = ""
-    prevLen = 0 # Find and replace only the longest format, for example, if "rd." exists, replace it with "road" but not "road."
-    for key in mapping:
-        if key in name:
-            if len(key) > prevLen:
-                betterName = name.replace(key, mapping[key])
-                prevLen = len(key)
-    if prevLen == 0: # Original street name is already formatted
-        betterName = name
-    return betterName
+    # Only the longest format found is replaced, for example, if "rd." exists, replace it with "road" but not "road."
+    return cleaning.normalize_street_name(name, mapping)
+
+
+def audit_report(street_types, phone_dict, not_in_shanghai, not_valid_postcode):
+    """
+    Turn results of audit() into a dictionary which can be saved as json.
+
+    Returns:
+        dictionary: "street_types" => street type to sorted street names,
+                    "street_names" => street name to its name after update_name(),
+                    "phones" => phone number to its unified format,
+                    "not_in_shanghai" => sorted city names,
+                    "not_valid_postcode" => sorted not valid postcodes
+    """
+    street_names = {}
+    for names in street_types.itervalues():
+        for name in names:
+            street_names[name] = update_name(name, mapping)
+    return {"street_types": dict((st_type, sorted(names)) for st_type, names in street_types.iteritems()),
+            "street_names": street_names,
+            "phones": dict(phone_dict),
+            "not_in_shanghai": sorted(not_in_shanghai),
+            "not_valid_postcode": sorted(set(tag.attrib['v'] for tag in not_valid_postcode))}
+
+
+def merge_audit_reports(reports):
+    """
+    Merge reports of audit_report() built on different parts of one file, for example by worker processes.
+
+    Args:
+        param_1(list): reports of audit_report()
+    Returns:
+        dictionary: merged report, same format as audit_report()
+    """
+    street_types = defaultdict(set)
+    rst = {"street_names": {}, "phones": {}, "not_in_shanghai": set(), "not_valid_postcode": set()}
+    for report in reports:
+        for st_type, names in report["street_types"].iteritems():
+            street_types[st_type].update(names)
+        rst["street_names"].update(report["street_names"])
+        rst["phones"].update(report["phones"])
+        rst["not_in_shanghai"].update(report["not_in_shanghai"])
+        rst["not_valid_postcode"].update(report["not_valid_postcode"])
+    rst["street_types"] = dict((st_type, sorted(names)) for st_type, names in street_types.iteritems())
+    rst["not_in_shanghai"] = sorted(rst["not_in_shanghai"])
+    rst["not_valid_postcode"] = sorted(rst["not_valid_postcode"])
+    return rst
+
+
+def write_audit_report(report, file_out):
+    """
+    Save a report of audit_report() as a json file.
+    """
+    with codecs.open(file_out, "w") as fo:
+        fo.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
 
 
 def test():
-    st_types, phone_dict, not_in_shanghai, not_valid_postcode = audit(OSMFILE)
+    st_types, phone_dict, not_in_shanghai, not_valid_postcode = cached_audit(OSMFILE)
 
     print "==========Begin to print street name and the formatted ones=========="
     for st_type, ways in st_types.iteritems():
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark.py times the hot paths of the scripts on a synthetic open street map file, so changes can be
+compared without the private shanghai_china.osm extract:
+1) generate_osm() writes an xml file of a given scale: number of nodes, ways per node, tags per tagged element,
+   and shares of messy street names, phone numbers and postcodes (same kinds of mess as the real extract);
+2) run_benchmarks() times mapparser.count_tags(), mapparser.count_keys(), audit.audit(), data.shape_element()
+   and data.process_map() on it. Every case runs in its own process, so its peak memory is its own,
+   and the best of several runs is kept;
+3) the report (elements/sec, MB/sec, peak memory of every case) is saved as json and can be compared with the
+   report of another commit by compare_reports().
+
+Usage:
+>>> python benchmark.py --nodes 200000 --out before.json
+>>> python benchmark.py --nodes 200000 --out after.json --compare before.json
+"""
+import argparse
+import codecs
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+import xml.etree.cElementTree as ET
+import osmstream
+
+# Shanghai area, where the generated nodes are
+MIN_LAT, MAX_LAT = 30.7, 31.5
+MIN_LON, MAX_LON = 121.0, 122.0
+
+CLEAN_STREETS = [u"Huaihai Road", u"Nanjing Road", u"Century Avenue", u"南京西路", u"Fuxing Street"]
+MESSY_STREETS = [u"Huaihai Rd.", u"Nanjing lu", u"Fuxing Raod", u"Century Ave", u"Changle St", u"Xinhua road",
+                 u"Wuding rd", u"Yan'an Lu", u"Hengshan street"]
+PHONES = [u"+86 21 {0:04d} {1:04d}", u"021-{0:04d}{1:04d}", u"(021) {0:04d}-{1:04d}", u"+86-21-{0:04d}-{1:04d}",
+          u"86 21 {0:04d}{1:04d} / 138{1:04d}{0:04d}"]
+VALID_POSTCODES = [u"200030", u"200040", u"201203", u"200120"]
+BAD_POSTCODES = [u"20003", u"200 040", u"Shanghai 200120", u"2001203"]
+CITIES = [u"Shanghai", u"上海", u"上海市", u"shanghai", u"Suzhou", u"Kunshan"]
+OTHER_TAGS = [(u"amenity", [u"restaurant", u"cafe", u"bank", u"school", u"hospital", u"toilets"]),
+              (u"name", [u"Jade Garden", u"人民公园", u"Bund Center", u"Xintiandi"]),
+              (u"name:en", [u"People's Park", u"Bund Center"]),
+              (u"highway", [u"bus_stop", u"traffic_signals", u"crossing"]),
+              (u"shop", [u"convenience", u"supermarket", u"clothes"]),
+              (u"addr:housenumber", [u"1", u"23", u"456", u"7890"]),
+              (u"addr:street:name", [u"Huaihai"]), # Second ":" is dropped by data.shape_element()
+              (u"building", [u"yes", u"residential"]),
+              (u"created_by", [u"JOSM", u"Potlatch 0.10f"])]
+
+def _escape(value):
+    return value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u'"', u"&quot;")
+
+def _tags(rnd, num_tags, messy_street_share, phone_share, postcode_share, serial):
+    """
+    Tags of one tagged element: address, phone and postcode by their shares, then other tags up to num_tags.
+    """
+    tags = []
+    if rnd.random() < 0.5:
+        streets = MESSY_STREETS if rnd.random() < messy_street_share else CLEAN_STREETS
+        tags.append((u"addr:street", rnd.choice(streets)))
+    if rnd.random() < phone_share:
+        tags.append((u"contact:phone", rnd.choice(PHONES).format(serial % 10000, (serial * 7) % 10000)))
+    if rnd.random() < postcode_share:
+        tags.append((u"addr:postcode", rnd.choice(VALID_POSTCODES if rnd.random() < 0.7 else BAD_POSTCODES)))
+        if rnd.random() < 0.5:
+            tags.append((u"addr:city", rnd.choice(CITIES)))
+    keys = set(k for k, _ in tags)
+    for key, values in rnd.sample(OTHER_TAGS, len(OTHER_TAGS)):
+        if len(tags) >= num_tags:
+            break
+        if key not in keys:
+            tags.append((key, rnd.choice(values)))
+    return tags
+
+def generate_osm(file_out, num_nodes = 100000, way_ratio = 0.2, tags_per_element = 3, tagged_share = 0.3,
+                 messy_street_share = 0.5, phone_share = 0.2, postcode_share = 0.2, seed = 0):
+    """
+    Write a synthetic open street map xml file: nodes first, then ways referring to them, one element
+    start per line like real extracts (so it can be sharded by osmstream.shard_offsets()).
+
+    Args:
+        param_1(string): output file name
+        param_2(int): number of nodes, default 100000
+        param_3(float): number of ways per node, default 0.2
+        param_4(int): number of tags of every tagged node and every way, default 3
+        param_5(float): share of nodes having tags, default 0.3
+        param_6(float): share of street names needing update_name(), default 0.5
+        param_7(float): share of tagged elements having a phone number, default 0.2
+        param_8(float): share of tagged elements having a postcode (30% of them are not valid), default 0.2
+        param_9(int): random seed, the same arguments give the same file, default 0
+    Returns:
+        dictionary: number of "node", "way" and "tag" elements written, and "bytes" of the file
+    """
+    rnd = random.Random(seed)
+    counts = {"node": 0, "way": 0, "tag": 0}
+    with codecs.open(file_out, "w", "utf-8") as f:
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark.py">\n')
+        f.write(u' <bounds minlat="{}" minlon="{}" maxlat="{}" maxlon="{}"/>\n'.format(MIN_LAT, MIN_LON,
+                                                                                      MAX_LAT, MAX_LON))
+        for node_id in xrange(1, num_nodes + 1):
+            attrs = u'id="{0}" version="{1}" changeset="{2}" timestamp="2015-06-0{1}T08:00:00Z" user="user{3}" ' \
+                    u'uid="{3}" lat="{4:.7f}" lon="{5:.7f}"'.format(node_id, rnd.randint(1, 9),
+                                                                    rnd.randint(1, 40000000), rnd.randint(1, 500),
+                                                                    rnd.uniform(MIN_LAT, MAX_LAT),
+                                                                    rnd.uniform(MIN_LON, MAX_LON))
+            counts["node"] += 1
+            if rnd.random() >= tagged_share:
+                f.write(u' <node {}/>\n'.format(attrs))
+                continue
+            f.write(u' <node {}>\n'.format(attrs))
+            for k, v in _tags(rnd, tags_per_element, messy_street_share, phone_share, postcode_share, node_id):
+                f.write(u'  <tag k="{}" v="{}"/>\n'.format(k, _escape(v)))
+                counts["tag"] += 1
+            f.write(u' </node>\n')
+        for way_id in xrange(1, int(num_nodes * way_ratio) + 1):
+            f.write(u' <way id="{}" version="1" changeset="{}" timestamp="2015-06-01T08:00:00Z" user="user{}" '
+                    u'uid="{}">\n'.format(way_id, rnd.randint(1, 40000000), way_id % 500, way_id % 500))
+            start = rnd.randint(1, num_nodes)
+            refs = [min(start + n, num_nodes) for n in range(rnd.randint(2, 12))]
+            if rnd.random() < 0.3: # Closed way
+                refs.append(refs[0])
+            for ref in refs:
+                f.write(u'  <nd ref="{}"/>\n'.format(ref))
+            for k, v in _tags(rnd, tags_per_element, messy_street_share, phone_share, postcode_share, way_id):
+                f.write(u'  <tag k="{}" v="{}"/>\n'.format(k, _escape(v)))
+                counts["tag"] += 1
+            f.write(u' </way>\n')
+            counts["way"] += 1
+        f.write(u'</osm>\n')
+    counts["bytes"] = os.path.getsize(file_out)
+    return counts
+
+def _bench_count_tags(filename):
+    import mapparser
+    mapparser.count_tags(filename)
+
+def _bench_count_keys(filename):
+    import mapparser
+    mapparser.count_keys(filename)
+
+def _bench_audit(filename):
+    import audit
+    audit.audit(filename)
+
+def _bench_shape_element(filename):
+    """
+    Time data.shape_element() alone: elements are parsed into memory before the clock starts.
+    """
+    import data
+    elements = [elem for elem in ET.parse(filename).getroot() if elem.tag == "node" or elem.tag == "way"]
+    start = time.time()
+    for elem in elements:
+        data.shape_element(elem)
+    return time.time() - start
+
+def _bench_process_map(filename):
+    import data
+    data.process_map(filename)
+
+def _bench_process_map_workers(filename):
+    import data
+    data.process_map(filename, workers=WORKERS)
+
+WORKERS = 4 # Worker processes of "process_map_workers" case
+CASES = [("count_tags", _bench_count_tags),
+         ("count_keys", _bench_count_keys),
+         ("audit", _bench_audit),
+         ("shape_element", _bench_shape_element),
+         ("process_map", _bench_process_map),
+         ("process_map_workers", _bench_process_map_workers)]
+
+def _run_case(name, filename, conn):
+    """
+    Run one case in a child process, with its output thrown away, and send (seconds, peak memory usage in MB
+    of the process) or the error to the parent.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno()) # Progress lines of the scripts
+    try:
+        func = dict(CASES)[name]
+        start = time.time()
+        seconds = func(filename)
+        if seconds is None:
+            seconds = time.time() - start
+        sys.stdout.flush()
+        conn.send((seconds, osmstream.peak_rss_mb()))
+    except Exception as e:
+        conn.send(e)
+        raise
+
+def run_case(name, filename):
+    """
+    Run one case in a new process (not a pool worker, so it can start its own pool), so peak memory is its own.
+
+    Returns:
+        tuple: (seconds, peak memory usage in MB)
+    """
+    receiver, sender = Pipe(duplex=False)
+    proc = Process(target=_run_case, args=(name, filename, sender))
+    proc.start()
+    rst = receiver.recv()
+    proc.join()
+    if isinstance(rst, Exception):
+        raise rst
+    return rst
+
+def run_benchmarks(filename, counts, cases = None, repeat = 3):
+    """
+    Time cases on a file of generate_osm().
+
+    Args:
+        param_1(string): input xml file name
+        param_2(dictionary): counts returned by generate_osm()
+        param_3(list): names of CASES to run, default None (all)
+        param_4(int): runs of every case, the fastest one is kept, default 3
+    Returns:
+        dictionary: Keys are case names, values are {"seconds", "elements_per_sec", "mb_per_sec", "peak_rss_mb"}
+    """
+    elements = counts["node"] + counts["way"]
+    rst = {}
+    for name, _ in CASES:
+        if cases is not None and name not in cases:
+            continue
+        runs = [run_case(name, filename) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        peaks = [run[1] for run in runs if run[1] is not None]
+        rst[name] = {"seconds": seconds,
+                     "elements_per_sec": elements / max(seconds, 1e-9),
+                     "mb_per_sec": counts["bytes"] / 1.0e6 / max(seconds, 1e-9),
+                     "peak_rss_mb": max(peaks) if peaks else None}
+        print "{:>20}: {:8.3f} s, {:10.0f} elements/sec, {:6.1f} MB/sec, peak {} MB".format(
+            name, seconds, rst[name]["elements_per_sec"], rst[name]["mb_per_sec"], rst[name]["peak_rss_mb"])
+    return rst
+
+def compare_reports(old, new, threshold = 0.1):
+    """
+    Print throughput and memory changes between two benchmark reports of the same scale.
+
+    Args:
+        param_1(dictionary): report of an earlier run
+        param_2(dictionary): report of this run
+        param_3(float): relative slow down flagged as regression, default 0.1 (10%)
+    Returns:
+        list: names of cases slower than threshold
+    """
+    regressions = []
+    if old["config"] != new["config"]:
+        print "Warning: reports were run with different configs"
+    for name, stats in sorted(new["results"].iteritems()):
+        if name not in old["results"]:
+            continue
+        before = old["results"][name]
+        change = stats["elements_per_sec"] / before["elements_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print "{:>20}: {:+.1%} elements/sec, peak {} => {} MB{}".format(name, change, before["peak_rss_mb"],
+                                                                       stats["peak_rss_mb"], flag)
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark the scripts on a synthetic open street map file.")
+    parser.add_argument("--nodes", type=int, default=100000, help="number of nodes")
+    parser.add_argument("--way-ratio", type=float, default=0.2, help="number of ways per node")
+    parser.add_argument("--tags", type=int, default=3, help="tags per tagged element")
+    parser.add_argument("--tagged", type=float, default=0.3, help="share of nodes having tags")
+    parser.add_argument("--messy-streets", type=float, default=0.5, help="share of messy street names")
+    parser.add_argument("--phones", type=float, default=0.2, help="share of tagged elements with a phone")
+    parser.add_argument("--postcodes", type=float, default=0.2, help="share of tagged elements with a postcode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every case, the fastest is kept")
+    parser.add_argument("--cases", nargs="*", help="cases to run, default all: " + " ".join(n for n, _ in CASES))
+    parser.add_argument("--out", default="benchmark.json", help="json report file")
+    parser.add_argument("--compare", help="json report of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    config = {"nodes": args.nodes, "way_ratio": args.way_ratio, "tags": args.tags, "tagged": args.tagged,
+              "messy_streets": args.messy_streets, "phones": args.phones, "postcodes": args.postcodes,
+              "seed": args.seed}
+    tmp = tempfile.mkdtemp(prefix="osm_benchmark")
+    try:
+        filename = os.path.join(tmp, "synthetic.osm")
+        counts = generate_osm(filename, args.nodes, args.way_ratio, args.tags, args.tagged, args.messy_streets,
+                              args.phones, args.postcodes, args.seed)
+        print "Generated {node} nodes, {way} ways, {tag} tags, {bytes} bytes".format(**counts)
+        results = run_benchmarks(filename, counts, args.cases, args.repeat)
+    finally:
+        shutil.rmtree(tmp)
+    report = {"config": config, "counts": counts, "results": results, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(args.out, "w") as fo:
+        fo.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
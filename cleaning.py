@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+cleaning.py contains cleaning helpers shared by audit.py and data.py, built once and then applied
+to every tag of the open street map file. Region settings (postcode format, city names, phone digits) are
+given by rules.py, from cleaning_rules.json.
+
+Usage:
+>>> import cleaning
+>>> cleaning.normalize_street_name("Huaihai Rd.", {"Rd.": "Road", "Rd": "Road"})
+'Huaihai Road'
+>>> cleaning.ValueCleaner(r'^\d{6}$', ["Shanghai"], 11).clean_phones(["+86 21 6215-0123", "021 62150123"])
+['62162150123', '02162150123']
+>>> python cleaning.py  # Benchmark phone cleaning on shanghai_china.osm
+"""
+import re
+import time
+
+STREET_CACHE_SIZE = 100000 # Number of distinct raw street names remembered by a normalizer
+VALUE_CACHE_SIZE = 100000 # Number of distinct raw phones (postcodes) remembered by a value cleaner
+NORMALIZER_CACHE_SIZE = 16 # Number of distinct mappings whose normalizers are kept by get_street_normalizer()
+_NOT_DIGITS = "".join(chr(n) for n in range(256) if not chr(n).isdigit()) # Deleted from byte strings
+_NOT_DIGITS_OR_NEWLINE = _NOT_DIGITS.replace("\n", "")
+
+class StreetNameNormalizer(object):
+    """
+    Update unformatted street names using a given mapping, same as audit.update_name() and
+    data.format_street_name() did by trying every key of the mapping one by one:
+    the longest key found in the name is chosen and all its appearances are replaced.
+
+    Keys are sorted once from the longest to the shortest, so the search stops at the first length where a key
+    is found instead of trying every key. When several keys of the same length are found, the one appearing
+    first in the name is chosen (the old loop depended on dictionary order).
+
+    Results are kept in a LRU cache keyed on the raw name, since the same streets appear again and again
+    in an extract. The cache has two generations of plain dictionaries, a hit costs one dictionary lookup
+    and names not used during a whole generation are dropped.
+    """
+    def __init__(self, mapping, cache_size=STREET_CACHE_SIZE):
+        self.mapping = dict(mapping)
+        self.keys = sorted(self.mapping, key=lambda k: (-len(k), k)) # Longest key first
+        self.same_length = dict((key, [other for other in self.keys if len(other) == len(key)]) for key in self.keys)
+        self.cache_size = cache_size
+        self.recent = {}
+        self.older = {}
+
+    def __call__(self, name):
+        betterName = self.recent.get(name)
+        if betterName is None:
+            betterName = self.older.get(name)
+            if betterName is None:
+                betterName = self.normalize(name)
+            if len(self.recent) >= self.cache_size:
+                self.older = self.recent # Names not used since last swap are dropped with old generation
+                self.recent = {}
+            self.recent[name] = betterName
+        return betterName
+
+    def normalize(self, name):
+        """
+        Update one street name without looking at the cache.
+        """
+        for key in self.keys:
+            if key in name:
+                break
+        else:
+            return name # Original street name is already formatted
+        found = [other for other in self.same_length[key] if other in name]
+        best = min(found, key=name.find) if len(found) > 1 else key
+        return name.replace(best, self.mapping[best])
+
+_normalizers = {} # Items of a mapping, sorted => its normalizer
+
+def get_street_normalizer(mapping):
+    """
+    Get the normalizer compiled for the content of a mapping, so a changed mapping gets another normalizer.
+    At most NORMALIZER_CACHE_SIZE normalizers are kept.
+
+    Args:
+        param_1(dictionary): Keys are ill formatted street name parts
+                             Values are good formatted street name parts accordingly
+    Returns:
+        StreetNameNormalizer
+    """
+    key = tuple(sorted(mapping.iteritems()))
+    normalizer = _normalizers.get(key)
+    if normalizer is None:
+        if len(_normalizers) >= NORMALIZER_CACHE_SIZE:
+            _normalizers.clear()
+        normalizer = _normalizers[key] = StreetNameNormalizer(mapping)
+    return normalizer
+
+def normalize_street_name(name, mapping):
+    """
+    Update an unformatted street name to a unified formatted ones using a given mapping
+
+    Args:
+        param_1(string): street name string
+        param_2(dictionary): Keys are ill formatted street name parts
+                             Values are good formatted street name parts accordingly
+    Returns:
+        string: Formatted new street name of given old street name
+    """
+    return get_street_normalizer(mapping)(name)
+
+def phone_digits(phone, digits):
+    """
+    Extract useful information and reformat the phone number to a unified format: its last digits.
+    Same as the character loop of data.contactPhoneFormat() did, with one str.translate() (or unicode filter).
+
+    Args:
+        param_1(string): phone number string
+        param_2(int): number of last digits kept, "phone_digits" of the rules
+    Returns:
+        string: formatted phone number string
+    """
+    if isinstance(phone, unicode):
+        return filter(unicode.isdigit, phone)[-digits:]
+    return phone.translate(None, _NOT_DIGITS)[-digits:]
+
+def phone_digits_many(phones, digits):
+    """
+    Same as phone_digits() on every phone number, with one translate() over all of them joined by new lines.
+    """
+    if any("\n" in phone for phone in phones): # Joined values could not be split back
+        return [phone_digits(phone, digits) for phone in phones]
+    try:
+        joined = "\n".join(phones)
+    except UnicodeDecodeError: # Byte string which is not ascii next to unicode ones
+        return [phone_digits(phone, digits) for phone in phones]
+    if isinstance(joined, unicode):
+        table = dict.fromkeys(ord(c) for c in set(joined) if c != u"\n" and not c.isdigit())
+        kept = joined.translate(table)
+    else:
+        kept = joined.translate(None, _NOT_DIGITS_OR_NEWLINE)
+    return [phone[-digits:] for phone in kept.split("\n")]
+
+def valid_postcodes_many(postcodes, pattern):
+    """
+    Check every postcode against the postcode pattern of the rules, one search per value: searching all of
+    them joined by new lines would not give whole values for patterns with groups or alternatives (such as
+    "^\\d{5}(-\\d{4})?$"). ValueCleaner only gives values not seen before, so each one is searched once.
+    """
+    search = re.compile(pattern).search
+    return [search(postcode) is not None for postcode in postcodes]
+
+class ValueCleaner(object):
+    """
+    Batch cleaning of repeated tag values ("contact:phone", "addr:postcode", "addr:city"): a batch of values
+    is reduced to its distinct values not seen before, which are cleaned together by one vectorized
+    operation (*_many functions), results are remembered and looked up for every value of the batch.
+    Each cache is emptied once it holds VALUE_CACHE_SIZE values.
+
+    Args:
+        param_1(string): pattern of valid postcodes
+        param_2(iterable): city names of the region
+        param_3(int): number of last digits kept in phone numbers
+        param_4(int): number of values kept by each cache, default VALUE_CACHE_SIZE
+    """
+    def __init__(self, postcode, cities, digits, cache_size=VALUE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.postcode = postcode
+        self.cities = frozenset(cities)
+        self.digits = digits
+        self.phones = {}
+        self.postcodes = {}
+
+    def _batch(self, cache, values, clean_many):
+        missing = list(set(value for value in values if value not in cache))
+        if missing:
+            if len(cache) + len(missing) > self.cache_size:
+                cache.clear()
+            cache.update(zip(missing, clean_many(missing)))
+        return [cache[value] for value in values]
+
+    def clean_phones(self, phones):
+        """
+        Returns:
+            list: phone_digits() of every given phone number
+        """
+        return self._batch(self.phones, phones, lambda values: phone_digits_many(values, self.digits))
+
+    def valid_postcodes(self, postcodes):
+        """
+        Returns:
+            list: whether every given postcode is valid
+        """
+        return self._batch(self.postcodes, postcodes, lambda values: valid_postcodes_many(values, self.postcode))
+
+    def known_cities(self, cities):
+        """
+        Returns:
+            list: whether every given city is one of the cities of the region
+        """
+        return [city in self.cities for city in cities]
+
+def _phone_digits_loop(phone, digits):
+    """
+    Character by character loop used before phone_digits(), kept as the baseline of benchmark_phones().
+    """
+    tmp = ""
+    for i in range(0, len(phone)):
+        if phone[i].isdigit():
+            tmp = tmp + phone[i]
+    return tmp[-digits:]
+
+def benchmark_phones(phones, digits, batch_size=1000):
+    """
+    Compare phone cleaning of the old character loop, phone_digits() and ValueCleaner batches on the same values.
+
+    Args:
+        param_1(list): raw phone numbers, with their repetitions
+        param_2(int): number of last digits kept
+        param_3(int): number of values per batch, default 1000
+    Returns:
+        dictionary: Keys are method names, values are phone numbers per second
+    """
+    cleaner = ValueCleaner("", [], digits)
+    methods = [("loop", lambda values: [_phone_digits_loop(phone, digits) for phone in values]),
+               ("translate", lambda values: [phone_digits(phone, digits) for phone in values]),
+               ("batch", cleaner.clean_phones)]
+    expected = None
+    rst = {}
+    for name, clean in methods:
+        start = time.time()
+        cleaned = []
+        for n in range(0, len(phones), batch_size):
+            cleaned.extend(clean(phones[n:n + batch_size]))
+        rst[name] = len(phones) / max(time.time() - start, 1e-9)
+        if expected is None:
+            expected = cleaned
+        elif cleaned != expected:
+            raise AssertionError("{} does not give the same phone numbers as loop".format(name))
+        print "{:>9}: {} phones, {:.0f} phones/sec".format(name, len(phones), rst[name])
+    return rst
+
+def check_postcodes():
+    """
+    Check ValueCleaner.valid_postcodes() gives the same as a search of every value, for patterns with groups
+    and alternatives.
+    """
+    postcodes = ["200000", "12345", "12345-6789", "1234", "123-4567", "1234567", "ab", "xb", "a", "", "2000001"]
+    for pattern in [r'^\d{6}$', r'^\d{5}(-\d{4})?$', r'^(\d{3})-?(\d{4})$', r'^a|b$']:
+        cleaner = ValueCleaner(pattern, [], 11)
+        for batch in [postcodes, postcodes[::-1]]: # Second batch only hits the cache
+            rst = cleaner.valid_postcodes(batch)
+            if rst != [re.search(pattern, postcode) is not None for postcode in batch]:
+                raise AssertionError("Postcodes of {} are not checked as by re.search(): {}".format(pattern, rst))
+
+def test():
+    import osmstream
+    import rules
+    check_postcodes()
+    phones = [elem.attrib['v'] for _, elem in osmstream.iterparse_stream('shanghai_china.osm')
+              if elem.tag == "tag" and elem.attrib['k'] == "contact:phone"]
+    benchmark_phones(phones * max(1, 100000 // max(len(phones), 1)), rules.get_rules().phone_digits)
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+compression.py lets the scripts read and write compressed files (".gz", ".bz2", ".xz", ".zst") as if they were
+plain files, so the open street map extract and the converted output can stay compressed on disk.
+
+Decompression never runs in the parsing thread:
+- if the command line tool of the format (pigz/gzip, pbzip2/bzip2, xz, zstd) is found in PATH, it runs in
+  a separate process and its output is read through a pipe;
+- otherwise the python module (gzip, bz2, lzma or backports.lzma, zstandard) decompresses chunks in a
+  background thread, handed over through a bounded queue.
+Compression of output works the same way, with a tool process or a background thread.
+
+Concatenated streams (for example part files merged by data.process_map_parallel()) are read completely.
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm.bz2', compress='gz')  # Writes shanghai_china.osm.json.gz
+"""
+import bz2
+import gzip
+import os
+import subprocess
+import threading
+from Queue import Queue, Empty
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError: # xz without the xz tool needs lzma module
+        lzma = None
+try:
+    import zstandard
+except ImportError: # zst without the zstd tool needs zstandard module
+    zstandard = None
+
+READ_SIZE = 1 << 20 # Bytes decompressed at once by background thread
+QUEUE_SIZE = 8 # Chunks decompressed ahead of the parser
+USE_TOOLS = True # Prefer command line tools (separate process) to python modules (background thread)
+
+# Suffix => command line tools, in order of preference. All of them take -d, -c and -q options.
+TOOLS = {".gz": ["pigz", "gzip"], ".bz2": ["pbzip2", "bzip2"], ".xz": ["xz"], ".zst": ["zstd"]}
+SUFFIXES = sorted(TOOLS)
+
+def compression_suffix(filename):
+    """
+    Get compression suffix of a file name, None if the file is not compressed (or is not a file name).
+    """
+    if isinstance(filename, basestring):
+        for suffix in SUFFIXES:
+            if filename.endswith(suffix):
+                return suffix
+    return None
+
+def strip_suffix(filename):
+    """
+    File name without its compression suffix, for example "shanghai_china.osm.gz" => "shanghai_china.osm".
+    """
+    suffix = compression_suffix(filename)
+    return filename[:-len(suffix)] if suffix else filename
+
+def find_command(names):
+    """
+    Get first of given command line tools found in PATH, None if there is none.
+    """
+    for name in names:
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            if path and os.access(os.path.join(path, name), os.X_OK):
+                return name
+    return None
+
+def find_tool(suffix):
+    """
+    Get first command line tool of a compression suffix found in PATH, None if there is none.
+    """
+    return find_command(TOOLS[suffix])
+
+class _Reader(object):
+    """
+    Line iteration shared by readers, so json output can be read line by line.
+    """
+    def __iter__(self):
+        rest = ""
+        while True:
+            data = self.read(READ_SIZE)
+            if not data:
+                break
+            lines = (rest + data).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ProcessReader(_Reader):
+    """
+    Decompress a file with a command line tool running in its own process.
+    """
+    def __init__(self, tool, filename):
+        self.filename = filename
+        self.proc = subprocess.Popen([tool, "-d", "-c", "-q", filename], stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and self.proc.wait() != 0:
+            raise IOError("Failed to decompress {}".format(self.filename))
+        return data
+
+    def close(self):
+        if self.proc.poll() is None: # Stopped before the end
+            self.proc.terminate()
+            self.proc.stdout.close()
+            self.proc.wait()
+
+class _MultiStreamFile(object):
+    """
+    Reader of concatenated bz2 or xz streams, which BZ2File of Python 2 stops reading after the first one.
+    """
+    def __init__(self, filename, new_decompressor):
+        self.f = open(filename, "rb")
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+
+    def read(self, size):
+        while True:
+            raw = self.f.read(size)
+            if not raw:
+                return ""
+            out = []
+            while raw:
+                try:
+                    out.append(self.decompressor.decompress(raw))
+                except EOFError: # Previous stream ended exactly at the end of previous chunk
+                    self.decompressor = self.new_decompressor()
+                    continue
+                raw = self.decompressor.unused_data
+                if raw:
+                    self.decompressor = self.new_decompressor()
+            data = "".join(out)
+            if data:
+                return data
+
+    def close(self):
+        self.f.close()
+
+def _open_module(suffix, filename):
+    """
+    Open a compressed file for reading with the python module of its format.
+    """
+    if suffix == ".gz":
+        return gzip.GzipFile(filename, "rb")
+    if suffix == ".bz2":
+        return _MultiStreamFile(filename, bz2.BZ2Decompressor)
+    if suffix == ".xz" and lzma is not None:
+        return _MultiStreamFile(filename, lzma.LZMADecompressor)
+    if suffix == ".zst" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"))
+    raise ImportError("Neither {} nor its python module is installed to read {}".format(
+        " or ".join(TOOLS[suffix]), filename))
+
+class ThreadReader(_Reader):
+    """
+    Decompress a file with a python module in a background thread, which keeps up to QUEUE_SIZE chunks
+    ready for the parser. zlib, bz2 and lzma release the GIL while they work, so both threads run at once.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.queue = Queue(QUEUE_SIZE)
+        self.buf = ""
+        self.pos = 0
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self._decompress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+            while not self.stopped:
+                data = self.f.read(READ_SIZE)
+                self.queue.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self.error = e
+            self.queue.put("")
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) - self.pos < size) and not self.done:
+            data = self.queue.get()
+            if not data:
+                self.done = True
+                if self.error is not None:
+                    raise self.error
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        end = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive(): # Unblock the thread if the queue is full
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.f.close()
+
+def open_input(filename):
+    """
+    Open a file for reading, decompressed in another process or thread if its name has a compression suffix.
+
+    Args:
+        param_1(string): file name
+    Returns:
+        object: file like object with read(size), line iteration and close()
+    """
+    suffix = compression_suffix(filename)
+    if suffix is None:
+        return open(filename, "rb")
+    tool = find_tool(suffix) if USE_TOOLS else None
+    if tool is not None:
+        return ProcessReader(tool, filename)
+    return ThreadReader(_open_module(suffix, filename))
+
+class ProcessWriter(object):
+    """
+    Compress written data with a command line tool running in its own process.
+    """
+    def __init__(self, tool, filename):
+        self.filename = filename
+        self.fo = open(filename, "wb")
+        self.proc = subprocess.Popen([tool, "-c", "-q"], stdin=subprocess.PIPE, stdout=self.fo)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        code = self.proc.wait()
+        self.fo.close()
+        if code != 0:
+            raise IOError("Failed to compress {}".format(self.filename))
+
+class ThreadWriter(object):
+    """
+    Compress written data with a python module in a background thread.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.queue = Queue(QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _compress(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                self.f.write(data)
+        except Exception as e:
+            self.error = e
+            while self.queue.get() is not None: # Drop the rest, error is raised by close()
+                pass
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+def _open_module_output(suffix, filename):
+    """
+    Open a compressed file for writing with the python module of its format.
+    """
+    if suffix == ".gz":
+        return gzip.GzipFile(filename, "wb")
+    if suffix == ".bz2":
+        return bz2.BZ2File(filename, "wb")
+    if suffix == ".xz" and lzma is not None:
+        return lzma.LZMAFile(filename, "wb")
+    if suffix == ".zst" and zstandard is not None:
+        return zstandard.ZstdCompressor().stream_writer(open(filename, "wb"))
+    raise ImportError("Neither {} nor its python module is installed to write {}".format(
+        " or ".join(TOOLS[suffix]), filename))
+
+def open_output(filename):
+    """
+    Open a file for writing, compressed in another process or thread if its name has a compression suffix.
+    Part files compressed separately can be appended to each other, the result is a valid compressed file.
+
+    Args:
+        param_1(string): file name
+    Returns:
+        object: file like object with write(data) and close()
+    """
+    suffix = compression_suffix(filename)
+    if suffix is None:
+        return open(filename, "wb")
+    tool = find_tool(suffix) if USE_TOOLS else None
+    if tool is not None:
+        return ProcessWriter(tool, filename)
+    return ThreadWriter(_open_module_output(suffix, filename))
@@ -4,8 +4,22 @@ import xml.etree.cElementTree as ET
 from collections import defaultdict
 import pprint
 import re
-import codecs
 import json
+import os
+import shutil
+import time
+from multiprocessing import Pool
+import audit
+import compression
+import cleaning
+import geometry
+import metrics
+import osmpbf
+import osmstream
+import records
+import rules
+import stats
+import writers
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -95,29 +109,24 @@ Usage:
 
 lower = re.compile(r'^([a-z]|_)*$')
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-postcode_re = re.compile(r'^\d{6}$') # Valid postcode should only contains 6 continual digits
-street_type_re = re.compile(r'(\b\S+lu.*|\b\S+\.?$)', re.IGNORECASE) # Note that "lu" in Chinese PingYin means English word road
-
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons", u"路"] # "路" means road in Chinese
-
-mapping = { "St.": "Street",
-            "St": "Street",
-            "Ave": "Avenue",
-            "Rd.": "Road",
-            "Rd": "Road",
-            "Raod": "Road",
-            "road": "Road",
-            "rd": "Road",
-            "Lu": "Road",
-            "lu": "Road",
-            "street": "Street",
-            "avenue": "Avenue"
-            }
-
-CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
+cleaning_rules = rules.get_rules() # Cleaning rules of Shanghai, loaded from cleaning_rules.json
+tag_rules = rules.TagRules(cleaning_rules) # Tag key => handler of shape_element()
+problemchars = cleaning_rules.problem_chars
+street_type_re = cleaning_rules.street_type_re # Note that "lu" in Chinese PingYin means English word road
+expected = cleaning_rules.expected # "路" means road in Chinese
+mapping = cleaning_rules.mapping
+
+street_normalizer = cleaning_rules.street_normalizer # Same as format_street_name(name, mapping), compiled once
+
+CREATED = cleaning_rules.created
+UNINFO_KEYS = frozenset(["pos", "_id", "type", "id", "created", "created_by"]) # Keys counted by isInfo()
+NO_FIELD_HANDLERS = frozenset(["problem_key", "nested_address", "skip"]) # Tag handlers adding nothing
+FIELD_HANDLERS = frozenset(["field", "phone"]) # Tag handlers adding the tag key as it is
+PUSHDOWN = True # Skip elements before shaping them when is_uninformative() tells they would not be written
 COUNT = 0
+CLEAN_BATCH_SIZE = 1000 # Elements whose phones, postcodes and cities are cleaned together
+SHARDS_PER_WORKER = 4 # Several shards per worker so that a slow shard does not leave other workers idle
+CHECKPOINT_BYTES = 64 * 1024 * 1024 # Input bytes converted between two checkpoints
 
 def inc():
     """
@@ -139,22 +148,14 @@ def format_street_name(name, mapping):
     Returns:
         string: Formatted new street name of given old street name
     """
-    betterName = ""
-    prevLen = 0 # Find and replace only the longest format, for example, if "rd." exists, replace it with "road" but not "road."
-    for key in mapping:
-        if key in name:
-            if len(key) > prevLen:
-                betterName = name.replace(key, mapping[key])
-                prevLen = len(key)
-    if prevLen == 0: # Original street name is already formatted
-        betterName = name
-    return betterName
+    # Only the longest format found is replaced, for example, if "rd." exists, replace it with "road" but not "road."
+    return cleaning.normalize_street_name(name, mapping)
 
 def is_address_shanghai(city):
     """
     If element contains city info, check whether it is Shanghai?
     """
-    return (city == "Shanghai") or (city == "shanghai") or (city == u"上海") or (city == u"上海市") # Last two is Chinese version of Shanghai
+    return cleaning_rules.is_region_city(city)
 
 def isInfo(dict):
     """
@@ -163,10 +164,13 @@ def isInfo(dict):
     and it contains fields more than "pos", "_id", "type", "id", "created", "created_by".
 
     Args:
-        param_1(dictionary): a given dictionary containing one data extracted from xml file
+        param_1(dictionary): a given dictionary (or record of shape_record()) containing one data extracted from
+                             xml file
     Returns:
         boolean: whether this data is informative or not
     """
+    if isinstance(dict, records.Record):
+        return dict.is_info(UNINFO_KEYS, cleaning_rules.outside_flag)
     keys = dict.keys()
     cntUninfoKeys = 0
     if "pos" in keys:
@@ -181,7 +185,7 @@ def isInfo(dict):
         cntUninfoKeys += 1
     if "created_by" in keys:
         cntUninfoKeys += 1
-    if "not_in_Shanghai" in keys: # Not in Shanghai, so not informative
+    if cleaning_rules.outside_flag in keys: # Not in Shanghai ("not_in_Shanghai"), so not informative
         return False
     target = len(keys)
     return target > cntUninfoKeys
@@ -195,16 +199,11 @@ def contactPhoneFormat(str):
     Returns:
         Formatted phone number string 
     """
-    strLen = len(str)
-    tmp = ""
-    for i in range(0, strLen):
-        if str[i].isdigit():
-            tmp = tmp + str[i]
-    return tmp[-11:]
+    return cleaning.phone_digits(str, cleaning_rules.phone_digits)
 
-def shape_element(element):
+def shape_element(element, clean_values = True):
     """
-    Shape element to a good format or discard a not valid element.
+    Shape element to a good format or discard a not valid element, see shape_record().
     This function contains following parts:
     1) Add "CREATED" and change format of longtitude and latitude to floats
     2) Add all valid sub tags
@@ -219,123 +218,625 @@ def shape_element(element):
     put into key-value pairs as in xml file. Also if you want to see what field in data has been changed in progress, please uncomment 
     all the related print statements.
 
+    Phone numbers, postcodes and cities are cleaned by clean_elements(), right away or later with other elements.
+
     Args:
         param_1(string): element wait to be formatted
+        param_2(boolean): clean phone number, postcode and city now(True), or keep raw values for a later
+                          clean_elements() call on a batch of shaped elements(False), default True.
     Returns:
         dictionary: formatted element, none if this element is not valid 
     """
-    rst = {}
+    record = shape_record(element)
+    if record is None:
+        return None
+    if clean_values:
+        clean_elements([record])
+    return record.to_dict()
+
+_layouts = {} # Attribute names of an element => split of attribute_layout()
+
+def attribute_layout(names):
+    """
+    Split attribute names of an element, in their order, into names of plain attributes and of CREATED
+    attributes, and tell whether it has coordinates. Elements of a file have few different attribute names,
+    every split is done once.
+    """
+    layout = _layouts.get(names)
+    if layout is None:
+        layout = _layouts[names] = (records.intern_names(tuple(key for key in names if key not in CREATED and
+                                                                key != 'lon' and key != 'lat')),
+                                    records.intern_names(tuple(key for key in names if key in CREATED)),
+                                    'lat' in names and 'lon' in names)
+    return layout
+
+def position(attrib, has_pos):
+    """
+    "pos" of an element given its attributes and whether it has coordinates (see attribute_layout()),
+    (latitude, longitude), None if it has none. Coordinates are read by name, attributes of a dictionary have
+    no reliable order.
+    """
+    if not has_pos:
+        return None
+    return float(attrib['lat']), float(attrib['lon'])
+
+def is_uninformative(element):
+    """
+    Decide from a raw "node" or "way" element, before shaping it, that isInfo() would reject it once shaped and
+    cleaned, so shaping can be skipped. It is so if its "pos" is outside the boundary of the region of the rules,
+    or if it has only uninformative attributes and no "nd", and either no tag adding an informative field or an
+    address, or a city not in the region (or a tag named as the outside_flag of the rules). Elements it cannot
+    decide from attribute names, tag keys and cities are shaped as usual, so output is the same whether elements
+    are skipped or not. Ways with "nd" are always shaped, skipping is only worth it for nodes, which are most of
+    the elements.
+    Skipped elements count in the progress and in handler hits of tag_rules as if they were shaped.
+
+    Args:
+        param_1(element): complete xml element
+    Returns:
+        boolean: True if the element would not be written
+    """
+    if element.tag != "node" and element.tag != "way":
+        return False
+    attr_names, _, has_pos = attribute_layout(tuple(element.attrib))
+    outside = False
+    if has_pos and cleaning_rules.region_grid is not None:
+        lat, lon = position(element.attrib, has_pos)
+        outside = not cleaning_rules.is_region_pos(lat, lon)
+    if not outside and records.has_other_names(attr_names, UNINFO_KEYS):
+        return False
+    if len(element) == 0: # Most nodes
+        inc()
+        return True
+    names = []
+    cities = None
+    keep = False
+    for tag in element:
+        if tag.tag != 'tag':
+            if outside:
+                continue
+            return False # "nd" of a way, which is then shaped as usual
+        key = tag.attrib['k']
+        name = tag_rules.handler_name(key)
+        names.append(name)
+        if name in NO_FIELD_HANDLERS:
+            continue
+        if name in FIELD_HANDLERS:
+            if key == cleaning_rules.outside_flag:
+                outside = True
+            elif key not in UNINFO_KEYS:
+                keep = True
+        elif name == "city":
+            if cities is None:
+                cities = {}
+            cities[key] = tag.attrib['v'] # Last value of a key is the one kept by shaping
+        else:
+            keep = True
+    if cities is not None:
+        if all(cleaning_rules.value_cleaner.known_cities(cities.values())):
+            keep = True # Address with a known city
+        else:
+            outside = True
+    if keep and not outside:
+        return False
+    tag_rules.count(names)
+    inc()
+    return True
+
+def shape_record(element):
+    """
+    Shape element as shape_element(element, clean_values=False) into a compact records.Node or records.Way,
+    turned into the dictionary of shape_element() by its to_dict().
+
+    Args:
+        param_1(string): element wait to be formatted
+    Returns:
+        Record: formatted element, none if this element is not valid
+    """
     if element.tag == "node" or element.tag == "way":
         # If you do not want to see progress number, comment next line
         inc()
-        createdDict = {}
-        posArr = []
-        addressDict = {}
-        node_refs = []
-        for key in element.attrib:
-            if key in CREATED:
-                createdDict[key] = element.attrib[key]
-            elif key in ['lon', 'lat']:
-                posArr.append(float(element.attrib[key]))
-            else:
-                rst[key] = element.attrib[key]
-        if len(posArr) != 0:
-            posArr[0], posArr[1] = posArr[1], posArr[0]
-        # Add all valid sub tags
-        for node in element.findall('tag'):
-            valK = node.attrib['k']
-            if problemchars.match(valK):
-                continue
-            elif valK == 'contact:phone': # Format ill formatted phone number
-                # Uncomment next four lines of codes if you want to see changes in progress.
-                # print "==========Original Phone Format: "
-                # print node.attrib['v']
-                # print "==========Converted Phone Format: "
-                # print contactPhoneFormat(node.attrib['v'])
-                rst[valK] = contactPhoneFormat(node.attrib['v'])
-            elif valK == 'name:en': # If an English name is already exists, replace or add "name" using the English name
-                # Uncomment next four commant lines of codes if you want to see changes in progress
-                # print "==========name:en is "
-                # print node.attrib['v']
-                rst['name'] = node.attrib['v']
-                # print "==========name is "
-                # print rst['name']
-            elif valK[:5] == "addr:":
-                realKey = valK[5:]
-                if ":" in realKey: # No two ":" allowed in keys
-                    continue
-                else:
-                    if realKey == "postcode" and not postcode_re.search(node.attrib['v']): # Filter unvalid postcode
-                        # print Uncomment next two commant lines of codes if you want to see changes in progress
-                        # print "==========Unvalid postcode: "
-                        # print node.attrib['v']
-                        continue
-                    elif realKey == "city" and not is_address_shanghai(node.attrib['v']):
-                        # print Uncomment next two commant lines of codes if you want to see changes in progress 
-                        # print "==========Not in Shanghai: "
-                        # print node.attrib['v']
-                        rst['not_in_Shanghai'] = True # Flag not in Shanghai
-                        continue
-                    elif realKey == "street" and street_type_re.search(node.attrib['v']): # Properly format English street name
-                        # print Uncomment next four commant lines of codes if you want to see changes in progress
-                        # print "==========Original Street Name: "
-                        # print node.attrib['v']
-                        # print "==========Formatted Street Name: "
-                        # print format_street_name(node.attrib['v'], mapping)
-                        addressDict[valK[5:]] = format_street_name(node.attrib['v'], mapping)
-                        continue
-                    else:
-                        addressDict[valK[5:]] = node.attrib['v']
-            else:
-                rst[node.attrib['k']] = node.attrib['v']
+        attrib = element.attrib
+        attr_names, created_names, has_pos = attribute_layout(tuple(attrib))
+        lat, lon = position(attrib, has_pos) or (None, None)
+        record_type = records.Way if element.tag == "way" else records.Node
+        rst = record_type(attr_names, tuple([attrib[key] for key in attr_names]), created_names,
+                          tuple([attrib[key] for key in created_names]), lat=lat, lon=lon)
+        tags = element.findall('tag')
+        if tags:
+            # Add all valid sub tags, each one by the handler of its key (see cleaning_rules.json and rules.py)
+            fields = rst.tag_fields()
+            addressDict = {}
+            for node in tags:
+                tag_rules.apply(fields, addressDict, node.attrib['k'], node.attrib['v'])
+            if len(addressDict) != 0:
+                rst.address = addressDict
         # Add all valid sub nds
-        if element.tag == "way":
-            rst['type'] = 'way'
-            for nds in element.findall('nd'):
-                node_refs.append(nds.attrib['ref'])
-        else:
-            rst['type'] = 'node'
-            for nds in element.findall('nd'):
-                node_refs.append(nds.attrib['ref'])
-        if len(node_refs) != 0:
-            rst['node_refs'] = node_refs
-        if len(addressDict) != 0:
-            rst['address'] = addressDict
-        if len(posArr) != 0:
-            rst['pos'] = posArr
-        if len(createdDict) != 0:
-            rst['created'] = createdDict
+        nds = element.findall('nd')
+        if nds:
+            rst.node_refs = records.node_refs_array([nd.attrib['ref'] for nd in nds])
         return rst
     else:
         return None
 
 
-def process_map(file_in, pretty = False):
+def element_position(el):
     """
-    Read in xml from a given input file, format data and output formatted data to an output file,
-    and output total input data number and total output data number.
+    Get "pos" of a shaped element (dictionary or record of shape_record()), None if it has none.
+    """
+    if isinstance(el, records.Record):
+        return (el.lat, el.lon) if el.lat is not None else None
+    return el.get('pos')
+
+def clean_elements(elements):
+    """
+    Clean values of a batch of elements shaped by shape_element(element, clean_values=False), in place:
+    1) Format phone numbers
+    2) Discard unvalid postcode fields
+    3) Discard cities not in Shanghai and flag their elements as not in Shanghai
+    4) Flag elements whose "pos" is outside the boundary of the region with the outside_flag of the rules, if
+       rules have a boundary
+    Fields are the ones of "phone", "postcode" and "city" rules of cleaning_rules.json, and every kind
+    of value of the whole batch is cleaned at once by the cleaning.ValueCleaner of the rules.
 
     Args:
-        param_1(string): input file name string
-        param_2(boolean): output in pretty format(True) or not(False), default False.
+        param_1(list): shaped elements (dictionaries or records of shape_record()), None items are skipped
     Returns:
         None
     """
-    file_out = "{0}.json".format(file_in)
+    cleaner = cleaning_rules.value_cleaner
+    for key in cleaning_rules.keys_of("phone"):
+        phones = [el for el in elements if el and key in el]
+        if phones:
+            for el, phone in zip(phones, cleaner.clean_phones([el[key] for el in phones])):
+                el[key] = phone
+    addresses = [el for el in elements if el and 'address' in el]
+    for field in cleaning_rules.address_fields_of("postcode"):
+        postcodes = [el['address'] for el in addresses if field in el['address']]
+        if postcodes:
+            for address, is_valid in zip(postcodes, cleaner.valid_postcodes([a[field] for a in postcodes])):
+                if not is_valid:
+                    # print "==========Unvalid postcode: ", address[field]
+                    del address[field]
+    for field in cleaning_rules.address_fields_of("city"):
+        cities = [el for el in addresses if field in el['address']]
+        if cities:
+            for el, is_in in zip(cities, cleaner.known_cities([el['address'][field] for el in cities])):
+                if not is_in:
+                    # print "==========Not in Shanghai: ", el['address'][field]
+                    del el['address'][field]
+                    el[cleaning_rules.outside_flag] = True # Flag not in Shanghai
+    for el in addresses:
+        if len(el['address']) == 0:
+            del el['address']
+    if cleaning_rules.region_grid is not None:
+        for el in elements:
+            pos = element_position(el) if el else None
+            if pos and not cleaning_rules.is_region_pos(pos[0], pos[1]):
+                el[cleaning_rules.outside_flag] = True # Flag outside the boundary
+
+def new_audit_results():
+    """
+    Empty containers to collect audit findings while converting, same as returned by audit.audit().
+    """
+    return defaultdict(set), defaultdict(set), set(), set()
+
+def stage_functions(writer, metrics = None):
+    """
+    Functions of every stage of convert_elements(), timed into a metrics.Metrics when given.
+    """
+    funcs = {"audit": audit.audit_element, "prefilter": is_uninformative, "shape": shape_record, "clean": clean_elements, "filter": isInfo,
+             "geometry": geometry.add_way_geometry, "write": writer.write}
+    if metrics is not None:
+        funcs = dict((stage, metrics.timed(func, stage)) for stage, func in funcs.iteritems())
+    return funcs
+
+def convert_elements(elements, writer, max_rss_mb = None, audit_results = None, node_store = None, metrics = None,
+                     summary = None):
+    """
+    Shape all given xml elements and write the informative ones with a given writer.
+
+    Args:
+        param_1(iterable): (event, element) pairs from ET.iterparse() or osmstream.iterparse_stream()
+        param_2(object): writer of shaped elements, such as writers.JsonWriter or mongoload.BulkWriter
+        param_3(float): peak memory budget in MB, raise MemoryError once it is exceeded, default None (no limit).
+        param_4(tuple): containers of new_audit_results(), audit every node/way into them when given, default None.
+        param_5(NodeStore): keep coordinates of every node in this geometry.NodeStore and add geometry of
+                            informative ways resolved from it when given, default None.
+        param_6(Metrics): count elements and time every stage into this metrics.Metrics when given, default None.
+        param_7(SummaryStats): add every written element to this stats.SummaryStats when given, default None.
+    Elements which is_uninformative() rejects are not shaped (unless PUSHDOWN is False), the others are shaped
+    into records (see shape_record()), cleaned by batches of CLEAN_BATCH_SIZE and turned into dictionaries only
+    when they are written, in input order.
+    Returns:
+        tuple: (total input data number, total output data number)
+    """
+    funcs = stage_functions(writer, metrics)
+    audit_element = funcs["audit"]
+    skip = funcs["prefilter"] if PUSHDOWN else None
+    shape = funcs["shape"]
+    if metrics is not None:
+        elements = metrics.timed_iter(elements, "parse")
     countTotal = 0
     countAdmit = 0
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            countTotal += 1
-            el = shape_element(element)
-            if el and isInfo(el): # Filter those records who are not informative
-                countAdmit += 1
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
+    batch = [] # Shaped elements waiting for clean_elements()
+    for _, element in elements:
+        countTotal += 1
+        if metrics is not None:
+            metrics.tick()
+        if audit_results is not None and (element.tag == "node" or element.tag == "way"):
+            audit_element(element, *audit_results)
+        if skip is not None and skip(element):
+            if metrics is not None:
+                metrics.skipped += 1
+            if node_store is not None and element.tag == "node": # Coordinates of every node are kept
+                pos = position(element.attrib, attribute_layout(tuple(element.attrib))[2])
+                if pos is not None:
+                    lat, lon = pos
+                    node_store.add(element.attrib['id'], lat, lon)
+            el = None
+        else:
+            el = shape(element)
+            if el and metrics is not None:
+                metrics.shaped += 1
+        if el:
+            if node_store is not None and el.lat is not None and el.TYPE == 'node':
+                node_store.add(element.attrib['id'], el.lat, el.lon) # el['id'] may be a tag named "id"
+            batch.append(el)
+            if len(batch) >= CLEAN_BATCH_SIZE:
+                countAdmit += write_elements(batch, funcs, node_store, summary)
+                batch = []
+        if (countTotal % osmstream.RSS_CHECK_INTERVAL) == 0:
+            osmstream.check_rss_budget(max_rss_mb)
+    countAdmit += write_elements(batch, funcs, node_store, summary)
+    if metrics is not None:
+        metrics.admitted += countAdmit
+        metrics.split("write", "encode", getattr(writer, "encode_time", 0.0))
+    return countTotal, countAdmit
+
+def write_elements(batch, funcs, node_store = None, summary = None):
+    """
+    Clean a batch of shaped elements and write the informative ones in order.
+
+    Args:
+        param_1(list): shaped records of shape_record()
+        param_2(dictionary): functions of stage_functions()
+        param_3(NodeStore): coordinates of nodes for geometry of ways, default None
+        param_4(SummaryStats): rollups of written elements, default None
+    Returns:
+        int: number of elements written
+    """
+    is_info = funcs["filter"]
+    add_way_geometry = funcs["geometry"]
+    write = funcs["write"]
+    funcs["clean"](batch)
+    count = 0
+    for el in batch:
+        if is_info(el): # Filter those records who are not informative
+            count += 1
+            el = el.to_dict()
+            if node_store is not None and el['type'] == 'way': # Added after isInfo(), new keys are not information
+                add_way_geometry(el, node_store)
+            if summary is not None:
+                summary.add(el)
+            write(el)
+    return count
+
+def process_shard(args):
+    """
+    Convert one byte range shard of input file into its own numbered part file. Run in worker processes.
+
+    Args:
+        param_1(tuple): (input file name, part file name, start offset, end offset, pretty, memory budget, with audit,
+                         output format, rule timing, with metrics, with stats)
+    Returns:
+        tuple: (total input data number, total output data number, peak memory usage in MB, audit report or None,
+                bytes written, encode time, rule report, metrics report or None, SummaryStats or None).
+               Synthetic root element of the shard is not counted.
+    """
+    (file_in, part_out, start, end, pretty, max_rss_mb, with_audit, output_format, rule_stats, with_metrics,
+     with_stats) = args
+    tag_rules.reset() # A worker process converts several shards
+    tag_rules.timed = rule_stats
+    run_metrics = metrics.Metrics(progress=False) if with_metrics else None
+    elements = osmstream.iterparse_shard(file_in, start, end)
+    audit_results = new_audit_results() if with_audit else None
+    summary = stats.SummaryStats() if with_stats else None
+    writer = writers.open_writer(output_format, part_out, pretty)
+    try:
+        countTotal, countAdmit = convert_elements(elements, writer, max_rss_mb, audit_results, metrics=run_metrics,
+                                                  summary=summary)
+    finally:
+        writer.close()
+    report = audit.audit_report(*audit_results) if with_audit else None
+    metrics_report = None
+    if run_metrics is not None:
+        run_metrics.elements -= 1 # Synthetic root
+        run_metrics.bytes_read = end - start
+        run_metrics.bytes_written = writer.bytes_written
+        metrics_report = run_metrics.report()
+    return (countTotal - 1, countAdmit, osmstream.peak_rss_mb(), report, writer.bytes_written, writer.encode_time,
+            tag_rules.report(), metrics_report, summary)
+
+def process_map_parallel(file_in, file_out, pretty, max_rss_mb, workers, parts, with_audit, output_format,
+                         rule_stats = False, with_metrics = False, with_stats = False):
+    """
+    Split input file into byte range shards and convert them in a pool of worker processes.
+    Results are either merged in order into the output file or kept as numbered part files
+    "<output>.part0000", "<output>.part0001", ... which can be given to mongoimport one by one.
+
+    Returns:
+        tuple: (total input data number, total output data number, peak memory usage in MB, audit report or None,
+                bytes written, encode time, rule report, metrics report or None, SummaryStats or None),
+               None if input file can not be sharded
+    """
+    start_time = time.time()
+    shards = osmstream.shard_offsets(file_in, workers * SHARDS_PER_WORKER)
+    if len(shards) == 0:
+        return None
+    suffix = compression.compression_suffix(file_out) or "" # Parts are compressed on their own, then appended
+    jobs = [(file_in, "{0}.part{1:04d}{2}".format(compression.strip_suffix(file_out), i, suffix), start, end, pretty,
+             max_rss_mb, with_audit, output_format, rule_stats, with_metrics, with_stats)
+            for i, (start, end) in enumerate(shards)]
+    pool = Pool(workers)
+    try:
+        results = pool.map(process_shard, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    if not parts:
+        with open(file_out, "wb") as fo:
+            for job in jobs:
+                with open(job[1], "rb") as fi:
+                    shutil.copyfileobj(fi, fo)
+                os.remove(job[1])
+    countTotal = sum(r[0] for r in results) + 1 # Add root "osm" element which is not in any shard
+    countAdmit = sum(r[1] for r in results)
+    peaks = [r[2] for r in results if r[2] is not None] + [osmstream.peak_rss_mb()]
+    report = audit.merge_audit_reports([r[3] for r in results]) if with_audit else None
+    summary = None
+    if with_stats:
+        summary = stats.SummaryStats()
+        for r in results:
+            summary.merge(r[8])
+    return (countTotal, countAdmit, max(peaks), report, sum(r[4] for r in results), sum(r[5] for r in results),
+            rules.merge_reports([r[6] for r in results]),
+            metrics.merge_reports([r[7] for r in results], time.time() - start_time) if with_metrics else None,
+            summary)
+
+def process_map_serial(file_in, file_out, pretty, stream, max_rss_mb, with_audit, writer, resolve_ways,
+                       output_format, rule_stats = False, with_metrics = False, with_stats = False):
+    """
+    Convert input file in this process, see process_map() for the arguments.
+
+    Returns:
+        tuple: same as process_map_parallel()
+    """
+    run_metrics = metrics.Metrics() if with_metrics else None
+    source = file_in
+    if not osmpbf.is_pbf(file_in) and (run_metrics is not None or not stream):
+        source = compression.open_input(file_in)
+        if run_metrics is not None:
+            source = metrics.CountingReader(source, run_metrics)
+    if stream or osmpbf.is_pbf(file_in):
+        elements = osmstream.iterparse_stream(source)
+    else:
+        elements = ET.iterparse(source)
+    audit_results = new_audit_results() if with_audit else None
+    tag_rules.reset()
+    tag_rules.timed = rule_stats
+    node_store = geometry.NodeStore() if resolve_ways else None
+    summary = stats.SummaryStats() if with_stats else None
+    out = writer if writer is not None else writers.open_writer(output_format, file_out, pretty)
+    try:
+        countTotal, countAdmit = convert_elements(elements, out, max_rss_mb, audit_results, node_store, run_metrics,
+                                                  summary)
+    finally:
+        out.close()
+        if source is not file_in:
+            source.close()
+    report = audit.audit_report(*audit_results) if with_audit else None
+    metrics_report = None
+    if run_metrics is not None:
+        if source is file_in: # PBF file is read by osmpbf.py
+            run_metrics.bytes_read = os.path.getsize(file_in)
+        run_metrics.bytes_written = getattr(out, "bytes_written", 0)
+        metrics_report = run_metrics.report()
+    return (countTotal, countAdmit, osmstream.peak_rss_mb(), report, getattr(out, "bytes_written", None),
+            getattr(out, "encode_time", None), tag_rules.report(), metrics_report, summary)
+
+def checkpoint_file(file_out):
+    return file_out + ".checkpoint"
+
+def load_checkpoint(file_in, file_out, output_format, pretty):
+    """
+    Load the checkpoint of an interrupted process_map_checkpointed() run, None if there is none.
+    Raise ValueError if it was written for another input file (or a changed one) or another output format.
+    """
+    name = checkpoint_file(file_out)
+    if not os.path.exists(name):
+        return None
+    with open(name) as f:
+        state = json.load(f)
+    stat = os.stat(file_in)
+    if (state["input"] != file_in or state["input_size"] != stat.st_size or state["input_mtime"] != stat.st_mtime
+            or state["output_format"] != output_format or state["pretty"] != pretty):
+        raise ValueError("Checkpoint {} does not match input file or output format, remove it to start again"
+                         .format(name))
+    return state
+
+def save_checkpoint(state, file_out):
+    """
+    Replace the checkpoint file at once, a crash while saving leaves the previous checkpoint.
+    """
+    name = checkpoint_file(file_out)
+    with open(name + ".tmp", "w") as fo:
+        fo.write(json.dumps(state, indent=2, sort_keys=True) + "\n")
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.rename(name + ".tmp", name)
+
+def process_map_checkpointed(file_in, file_out, pretty, max_rss_mb, with_audit, resolve_ways, output_format,
+                             rule_stats = False, with_metrics = False, with_stats = False):
+    """
+    Convert input file in this process by segments of about CHECKPOINT_BYTES, split like shards of
+    process_map_parallel(). Once a segment is written through to disk, "<output>.checkpoint" records input offset
+    of next segment, size of output file, countTotal, countAdmit, audit report and summary stats so far (and the
+    nodes of resolve_ways in "<output>.nodes"). If a checkpoint is found, conversion resumes after it: output file
+    is cut back to the checkpointed size, so records written after the checkpoint are not duplicated.
+    Checkpoint files are removed once conversion is complete.
+
+    Returns:
+        tuple: same as process_map_parallel(), None if input file can not be split into segments
+    """
+    stat = os.stat(file_in)
+    state = load_checkpoint(file_in, file_out, output_format, pretty)
+    resume_offset = None
+    if state is None:
+        state = {"input": file_in, "input_size": stat.st_size, "input_mtime": stat.st_mtime,
+                 "output_format": output_format, "pretty": pretty, "segment_bytes": CHECKPOINT_BYTES,
+                 "input_offset": 0, "output_offset": 0, "countTotal": 0, "countAdmit": 0, "audit": None,
+                 "node_store": None, "summary": None}
+    else:
+        resume_offset = state["output_offset"]
+        print "=========Resume from checkpoint at input byte {}, {} records done".format(state["input_offset"],
+                                                                                        state["countTotal"])
+    segments = osmstream.shard_offsets(file_in, max(1, stat.st_size // state["segment_bytes"]))
+    if len(segments) == 0:
+        return None
+    run_metrics = metrics.Metrics() if with_metrics else None
+    tag_rules.reset()
+    tag_rules.timed = rule_stats
+    node_store = None
+    if resolve_ways:
+        node_store = geometry.NodeStore.load(state["node_store"]) if state["node_store"] else geometry.NodeStore()
+    summary = None
+    if with_stats:
+        summary = stats.SummaryStats.from_dict(state["summary"]) if state["summary"] else stats.SummaryStats()
+    writer = writers.open_writer(output_format, file_out, pretty, resume_offset=resume_offset)
+    try:
+        for start, end in segments:
+            if start < state["input_offset"]: # Converted before the checkpoint
+                continue
+            audit_results = new_audit_results() if with_audit else None
+            total, admit = convert_elements(osmstream.iterparse_shard(file_in, start, end), writer, max_rss_mb,
+                                            audit_results, node_store, run_metrics, summary)
+            state["countTotal"] += total - 1 # Synthetic root of the segment
+            state["countAdmit"] += admit
+            if with_audit:
+                state["audit"] = audit.merge_audit_reports(
+                    [report for report in [state["audit"], audit.audit_report(*audit_results)] if report])
+            if summary is not None:
+                state["summary"] = summary.to_dict()
+            if run_metrics is not None:
+                run_metrics.elements -= 1
+                run_metrics.bytes_read += end - start
+            state["output_offset"] = writer.checkpoint()
+            if node_store is not None:
+                node_store.save(file_out + ".nodes.tmp")
+                os.rename(file_out + ".nodes.tmp", file_out + ".nodes")
+                state["node_store"] = file_out + ".nodes"
+            state["input_offset"] = end
+            save_checkpoint(state, file_out)
+    finally:
+        writer.close()
+    os.remove(checkpoint_file(file_out))
+    if state["node_store"]:
+        os.remove(state["node_store"])
+    metrics_report = None
+    if run_metrics is not None:
+        run_metrics.bytes_written = writer.bytes_written
+        metrics_report = run_metrics.report()
+    return (state["countTotal"] + 1, state["countAdmit"], osmstream.peak_rss_mb(), state["audit"],
+            writer.bytes_written, writer.encode_time, tag_rules.report(), metrics_report, summary)
+
+def process_map(file_in, pretty = False, stream = True, max_rss_mb = None, workers = 1, parts = False,
+                with_audit = False, writer = None, resolve_ways = False, output_format = "json", compress = None,
+                rule_stats = False, with_metrics = False, profile = None, checkpoint = False, with_stats = False):
+    """
+    Read in xml from a given input file, format data and output formatted data to an output file,
+    and output total input data number, total output data number and peak memory usage.
+
+    Args:
+        param_1(string): input file name string, xml file or PBF file (name ending with ".pbf"). Xml file
+                         may be compressed (name ending with one of compression.SUFFIXES), it is then
+                         converted in one process.
+        param_2(boolean): output in pretty format(True) or not(False), default False.
+        param_3(boolean): release every node/way once it is shaped(True) so memory usage does not grow
+                          with input size, or keep the whole xml tree in memory(False), default True.
+        param_4(float): peak memory budget in MB (per process), raise MemoryError once it is exceeded,
+                        default None (no limit).
+        param_5(int): number of worker processes, default 1. More than 1 converts byte range shards of
+                      input file in parallel, always in streaming mode.
+        param_6(boolean): with several workers, keep numbered part files(True) instead of merging
+                          them in order into one output file(False), default False.
+        param_7(boolean): also run audit.audit() checks in the same pass and save its report to
+                          "<input>.audit.json"(True), default False.
+        param_8(object): write shaped elements with this writer (for example mongoload.BulkWriter) instead of
+                         the json output file, default None. Conversion runs in one process with a writer.
+        param_9(boolean): add GeoJSON "geometry" and "bbox" of every way, resolved from coordinates of nodes
+                          met before it in the file(True), default False. Conversion runs in one process.
+        param_10(string): output file format, one of writers.FORMATS ("json", "bson", "msgpack", "parquet"),
+                          written to input file name (without compression suffix) followed by writers.EXTENSIONS,
+                          default "json".
+                          Parquet output is written in one process.
+        param_11(string): compress output file with "gz", "bz2", "xz" or "zst" (added to its name), default None.
+        param_12(boolean): measure time spent in every tag rule of rules.py and print it with the number of
+                           tags handled by the rule(True), default False.
+        param_13(boolean): measure time of every stage, throughput, bytes read and written, print a progress line
+                           every metrics.PROGRESS_SECONDS and save the report to "<input>.metrics.json"(True),
+                           default False.
+        param_14(string): profile the main process with "cprofile" or "py-spy", see metrics.profiling(),
+                          default None.
+        param_15(boolean): convert in one process and save a checkpoint every CHECKPOINT_BYTES of input, so that
+                           an interrupted run started again with the same arguments resumes from the last checkpoint
+                           instead of from the beginning(True), default False. Needs an uncompressed xml or PBF input
+                           file and an uncompressed output file of a writers.CONCATENABLE format.
+        param_16(boolean): keep summary rollups of written documents (see stats.py) and save them to
+                           "<input>.stats.json"(True), default False.
+    Returns:
+        None
+    """
+    file_out = compression.strip_suffix(file_in) + writers.EXTENSIONS[output_format]
+    if compress is not None:
+        file_out = "{0}.{1}".format(file_out, compress)
+    result = None
+    if checkpoint and (writer is not None or compress is not None or output_format not in writers.CONCATENABLE):
+        raise ValueError("Checkpoints need an uncompressed output file of one of {}".format(
+            ", ".join(sorted(writers.CONCATENABLE))))
+    with metrics.profiling(profile, file_in):
+        if checkpoint:
+            result = process_map_checkpointed(file_in, file_out, pretty, max_rss_mb, with_audit, resolve_ways,
+                                              output_format, rule_stats, with_metrics, with_stats)
+            if result is None:
+                raise ValueError("Cannot split {} into checkpointed segments".format(file_in))
+        elif (workers > 1 and writer is None and not resolve_ways # Shards would not see nodes of other shards
+                and output_format in writers.CONCATENABLE):
+            result = process_map_parallel(file_in, file_out, pretty, max_rss_mb, workers, parts, with_audit,
+                                          output_format, rule_stats, with_metrics, with_stats)
+            if result is None:
+                print "=========Cannot split input file into shards, convert it in one process"
+        if result is None:
+            result = process_map_serial(file_in, file_out, pretty, stream, max_rss_mb, with_audit, writer,
+                                        resolve_ways, output_format, rule_stats, with_metrics, with_stats)
+    countTotal, countAdmit, peak, report, bytes_written, encode_time, rule_report, metrics_report, summary = result
+    if report is not None:
+        audit.write_audit_report(report, "{0}.audit.json".format(file_in))
     print "=========Total records number is {}".format(countTotal)
     print "=========Total admit records number is {}".format(countAdmit)
+    print "=========Peak memory usage is {} MB".format(peak)
+    if bytes_written is not None:
+        print "=========Wrote {} MB of {} output, encode time {:.2f} s".format(bytes_written/1.0e6, output_format,
+                                                                             encode_time)
+    if rule_stats:
+        rules.print_report(rule_report)
+    if metrics_report is not None:
+        metrics.print_report(metrics_report)
+        metrics_report.update({"input": file_in, "output": file_out, "output_format": output_format,
+                               "workers": workers})
+        metrics.write_report(metrics_report, "{0}.metrics.json".format(file_in))
+    if summary is not None:
+        stats.write_report(summary.report(), "{0}.stats.json".format(file_in))
 
 def test():
     # NOTE: if you are running this code on your computer, with a larger dataset, 
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+geometry.py resolves "node_refs" of ways into coordinates while data.process_map() converts the file,
+so consumers get the shape of a way without one lookup per referenced node.
+
+Coordinates of all nodes (informative or not) are kept in a NodeStore: three flat arrays sorted by node id,
+16 bytes per node (64 bits id, latitude and longitude as 32 bits integers of 1e-7 degree, the precision of
+OSM files), instead of a dictionary of Python floats. Tens of millions of nodes take hundreds of MB
+and the store can be saved to disk and loaded again.
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm', resolve_ways=True)
+"""
+from array import array
+from bisect import bisect_left
+import heapq
+from itertools import izip, repeat
+
+SCALE = 1e7 # Coordinates are stored as integers of 1e-7 degree
+SORT_CHUNK = 1 << 20 # Nodes sorted at once when a store is not sorted, sorted chunks are then merged
+
+def _int_array(typecode_bytes):
+    """
+    Array typecode of a signed integer of given size, which depends on platform for 'l'.
+    """
+    for typecode in ('i', 'l', 'q'):
+        try:
+            if array(typecode).itemsize == typecode_bytes:
+                return typecode
+        except ValueError: # 'q' only exists in recent Python versions
+            pass
+    raise ValueError("No array type of {} bytes".format(typecode_bytes))
+
+ID_TYPE = _int_array(8)
+COORD_TYPE = _int_array(4)
+
+class NodeStore(object):
+    """
+    Compact node id => (latitude, longitude) store. Nodes come sorted by id in OSM files,
+    so adding them keeps arrays sorted and lookups are binary searches.
+    """
+    def __init__(self):
+        self.ids = array(ID_TYPE)
+        self.lats = array(COORD_TYPE)
+        self.lons = array(COORD_TYPE)
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if len(self.ids) != 0 and node_id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(node_id)
+        self.lats.append(int(round(float(lat) * SCALE)))
+        self.lons.append(int(round(float(lon) * SCALE)))
+
+    def _sort(self):
+        """
+        Sort by id, chunk by chunk of SORT_CHUNK nodes which are then merged into new arrays, so that no list
+        of all nodes is built. Nodes with the same id keep their order.
+        """
+        chunks = []
+        for start in xrange(0, len(self.ids), SORT_CHUNK):
+            ids = self.ids[start:start + SORT_CHUNK]
+            lats = self.lats[start:start + SORT_CHUNK]
+            lons = self.lons[start:start + SORT_CHUNK]
+            order = sorted(xrange(len(ids)), key=ids.__getitem__)
+            chunks.append((array(ID_TYPE, (ids[n] for n in order)), array(COORD_TYPE, (lats[n] for n in order)),
+                           array(COORD_TYPE, (lons[n] for n in order))))
+        if len(chunks) > 1:
+            self.ids, self.lats, self.lons = array(ID_TYPE), array(COORD_TYPE), array(COORD_TYPE)
+            merged = heapq.merge(*[izip(chunk_ids, repeat(number), chunk_lats, chunk_lons)
+                                   for number, (chunk_ids, chunk_lats, chunk_lons) in enumerate(chunks)])
+            for node_id, _, lat, lon in merged:
+                self.ids.append(node_id)
+                self.lats.append(lat)
+                self.lons.append(lon)
+        elif chunks:
+            self.ids, self.lats, self.lons = chunks[0]
+        self.sorted = True
+
+    def get(self, node_id):
+        """
+        Returns:
+            tuple: (latitude, longitude) of a node, None if the node is not in the store
+        """
+        if not self.sorted:
+            self._sort()
+        node_id = int(node_id)
+        n = bisect_left(self.ids, node_id)
+        if n == len(self.ids) or self.ids[n] != node_id:
+            return None
+        return self.lats[n] / SCALE, self.lons[n] / SCALE
+
+    def save(self, file_out):
+        """
+        Save store to a binary file, to resolve ways of other files (for example change files) later.
+        """
+        if not self.sorted:
+            self._sort()
+        with open(file_out, "wb") as f:
+            array(ID_TYPE, [len(self.ids)]).tofile(f)
+            self.ids.tofile(f)
+            self.lats.tofile(f)
+            self.lons.tofile(f)
+
+    @classmethod
+    def load(cls, file_in):
+        store = cls()
+        with open(file_in, "rb") as f:
+            size = array(ID_TYPE)
+            size.fromfile(f, 1)
+            store.ids.fromfile(f, size[0])
+            store.lats.fromfile(f, size[0])
+            store.lons.fromfile(f, size[0])
+        return store
+
+def is_area(way):
+    """
+    Check whether a closed way is an area (polygon) and not a closed line such as a roundabout.
+    """
+    if way['node_refs'][0] != way['node_refs'][-1] or len(way['node_refs']) < 4:
+        return False
+    if 'highway' in way or 'barrier' in way:
+        return way.get('area') == 'yes'
+    return way.get('area') != 'no'
+
+def add_way_geometry(way, store):
+    """
+    Add GeoJSON "geometry" (LineString or Polygon, [longitude, latitude] coordinates) and
+    "bbox" ([min longitude, min latitude, max longitude, max latitude], GeoJSON order) to a shaped way.
+    Nodes missing from the store (clipped by extract bounds) are skipped.
+
+    Args:
+        param_1(dictionary): way shaped by data.shape_element()
+        param_2(NodeStore): coordinates of nodes
+    Returns:
+        None
+    """
+    points = []
+    for ref in way.get('node_refs', []):
+        point = store.get(ref)
+        if point is not None:
+            points.append(point)
+    if len(points) < 2:
+        return
+    coordinates = [[lon, lat] for lat, lon in points]
+    if is_area(way) and len(points) == len(way['node_refs']):
+        way['geometry'] = {'type': 'Polygon', 'coordinates': [coordinates]}
+    else:
+        way['geometry'] = {'type': 'LineString', 'coordinates': coordinates}
+    lats = [lat for lat, _ in points]
+    lons = [lon for _, lon in points]
+    way['bbox'] = [min(lons), min(lats), max(lons), max(lats)]
@@ -11,59 +11,99 @@ Usage:
 """
 import os
 import subprocess
-from pymongo import MongoClient
+import mongoindex
+import mongoload
+import mongoreport
+import mongoupdate
+import stats
 
 db_name = 'openStreetMap'
 
 # Connect to Mongodb
-client = MongoClient('localhost:27017')
+client = mongoload.get_client('localhost:27017') # Same pooled client as used by direct loading
 db = client[db_name]
 
 # Build mongoimport command
 collection = 'shanghai'
 json_file = 'shanghai_china.osm.json'
+stats_file = 'shanghai_china.osm.stats.json' # Summary rollups saved by data.process_map(with_stats=True)
 
 mongoimport_cmd = 'mongoimport -h 127.0.0.1:27017 ' + \
                   '--db ' + db_name + \
                   ' --collection ' + collection + \
                   ' --file ' + json_file
 
+# Set to True to convert the OSM file and insert it directly with mongoload, without JSON file nor mongoimport
+direct_load = False
+
+# Set to an OSM change file (.osc) to update the existing collection in place instead of dropping and reimporting it
+change_file = None
+
 # Before importing, drop collection if it is already running 
-if collection in db.collection_names():
+if change_file is None and collection in db.collection_names():
     print 'Dropping collection: ' + collection
     db[collection].drop()
 
-# Execute the command
-print 'Executing: ' + mongoimport_cmd
-subprocess.call(mongoimport_cmd.split())
+# Summary rollups of the loaded data, the general statistics below are read from them instead of queried
+summary = None
+
+if change_file is not None:
+    print 'Applying changes of ' + change_file + ' to ' + collection
+    mongoupdate.apply_changes(change_file, db[collection])
+    db[stats.STATS_COLLECTION].delete_one({'_id': collection}) # Rollups do not include the changes
+elif direct_load:
+    print 'Loading shanghai_china.osm directly into ' + collection
+    mongoload.load_map('shanghai_china.osm', db_name, collection, drop=False, with_stats=True)
+    summary = stats.load_from_collection(db, collection)
+else:
+    # Execute the command
+    print 'Executing: ' + mongoimport_cmd
+    subprocess.call(mongoimport_cmd.split())
+    mongoreport.bump_generation(db, collection) # Cached query results are of the previous data
+    # Rollups are written after the JSON file by the same conversion, an older file belongs to another conversion
+    if os.path.exists(stats_file) and os.path.getmtime(stats_file) >= os.path.getmtime(json_file):
+        summary = stats.load_report(stats_file)
+        stats.save_to_collection(summary, db, collection)
 
 shanghai = db[collection]
 
+# Build indexes used by following queries, after loading so that they do not slow it down
+mongoindex.ensure_indexes(shanghai)
+
 print 'The original OSM file is {} MB'.format(os.path.getsize('shanghai_china.osm')/1.0e6) # convert from bytes to megabytes
-print 'The JSON file is {} MB'.format(os.path.getsize(json_file)/1.0e6) # convert from bytes to megabytes
+if change_file is None and not direct_load:
+    print 'The JSON file is {} MB'.format(os.path.getsize(json_file)/1.0e6) # convert from bytes to megabytes
 
 # Begin to run queries
 
+# Results read from summary rollups when there are some, the other queries run concurrently
+results = mongoreport.summary_results(summary) if summary is not None else {}
+runner = mongoreport.ReportRunner(db, collection)
+results.update(runner.run([name for name in mongoreport.QUERY_NAMES if name not in results]))
+
 # First part: display general statistic info of whole dataset
+if summary is not None:
+    print "Read from summary rollups" + ("" if summary['exact'] else " (distinct counts are estimated)")
+
 print "Total number of records:"
-total_num_records = shanghai.find().count()
+total_num_records = results['records']
 print(total_num_records)
 
 print "Total number of unique users:"
-unique_num_users = len(shanghai.find().distinct("created.user"))
+unique_num_users = results['users']
 print(unique_num_users)
 
 print "Total number of nodes:"
-total_num_nodes = shanghai.find({'type':'node'}).count()
+total_num_nodes = results['nodes']
 print(total_num_nodes)
 
 print "Total number of ways:"
-total_num_ways = shanghai.find({'type':'way'}).count()
+total_num_ways = results['ways']
 print(total_num_ways)
 
 # Second part: confirm dataset meets data cleaning criteria
 print "Display postcodes:"
-postcodes = shanghai.find().distinct("address.postcode")
+postcodes = results['postcode_values']
 print(list(postcodes))
 
 # print "Display street names:"
@@ -75,28 +115,21 @@ print(list(postcodes))
 # print(list(names)) # Only English name is human readable.
 
 print "Display phone numbers:"
-phones = shanghai.find().distinct("contact:phone")
+phones = results['phone_values']
 print(list(phones))
 
 # Third part: dig into and think more about this dataset
 print "Top three most mentioned amenity:"
-amenity_top_three = shanghai.aggregate([
-	{"$match":{"amenity":{"$exists":1}}},
-	{"$group":{"_id":"$amenity", "count":{"$sum":1}}},
-	{"$sort": {"count": -1}},
-	{"$limit": 3}
-])
+amenity_top_three = results['amenity_top']
 print(list(amenity_top_three))
 
 print "Number of amenities only appear once:"
-num_amenity_only_once = shanghai.aggregate([
-	{"$group": {"_id":"$amenity", "count": {"$sum": 1}}},
-	{"$group": {"_id":"$count", "num_amenity":{"$sum":1}}},
-	{"$sort": {"_id":1}},
-	{"$limit": 1}
-])
+num_amenity_only_once = results['amenity_frequency']
 print(list(num_amenity_only_once))
 
+# Latency of queries which were not answered by the rollups
+runner.print_timings()
+
 
 
 
@@ -7,9 +7,12 @@ Usage:
 >>> python mapparser.py
 """
 
-import xml.etree.cElementTree as ET
+from collections import defaultdict
 import pprint
-import re
+import osmstream
+import sketch
+
+NUM_SAMPLES = 5 # Number of distinct sample values kept for every key
 
 def count_keys(filename):
     """
@@ -26,11 +29,11 @@ def count_keys(filename):
     """
     fields = {}
     count = 0
-    for _, node in ET.iterparse(filename):
+    for _, node in osmstream.iterparse_stream(filename):
         if node.tag == 'tag':
             for tag in node.iter('tag'):
                 k = tag.get('k')
-                if k in fields.keys():
+                if k in fields:
                     fields[k] = fields[k] + 1
                 else:
                     fields[k] = 1
@@ -55,7 +58,7 @@ def count_tags(filename):
     """
     tags = {}
     count = 0
-    for _, node in ET.iterparse(filename):
+    for _, node in osmstream.iterparse_stream(filename):
         tag = node.tag
         if tag not in tags:
             tags[tag] = 1
@@ -67,13 +70,53 @@ def count_tags(filename):
             print "count_tags=> {}".format(count)
     return tags
 
+def profile_map(filename, num_samples = NUM_SAMPLES):
+    """
+    Get the same whole picture as count_tags() and count_keys() in a single pass of a xml file,
+    together with an estimate of distinct values number and some sample values of every key.
+    Memory usage stays bounded whatever the file size: elements are released once counted
+    and distinct values are estimated with a fixed size sketch instead of kept in sets.
+
+    Args:
+        param_1(string): Input xml file name.
+        param_2(int): Number of distinct sample values to keep for every key, default NUM_SAMPLES.
+    Returns:
+        tags => a dictionary mapping distinct tags to their appearance, same as count_tags()
+        keys => a dictionary mapping distinct k value of 'tag' to their appearance, same as count_keys()
+        cardinality => a dictionary mapping distinct k value of 'tag' to estimated number of distinct v values
+        samples => a dictionary mapping distinct k value of 'tag' to a list of its first distinct v values
+    """
+    tags = defaultdict(int)
+    keys = defaultdict(int)
+    sketches = defaultdict(sketch.HyperLogLog)
+    samples = defaultdict(list)
+    count = 0
+    for _, node in osmstream.iterparse_stream(filename):
+        tags[node.tag] += 1
+        if node.tag == 'tag':
+            k = node.get('k')
+            v = node.get('v')
+            keys[k] += 1
+            sketches[k].add(v)
+            if len(samples[k]) < num_samples and v not in samples[k]:
+                samples[k].append(v)
+        count += 1
+        # Uncomment following two lines to show progress
+        # if (count % 10000) == 0:
+        #     print "profile_map=> {}".format(count)
+    cardinality = dict((k, hll.count()) for k, hll in sketches.iteritems())
+    return dict(tags), dict(keys), cardinality, dict(samples)
+
 def test():
-    tags = count_tags('shanghai_china.osm')
-    keys = count_keys('shanghai_china.osm')
+    tags, keys, cardinality, samples = profile_map('shanghai_china.osm')
     print "==========Different TAGs and their counts=========="
     pprint.pprint(tags)
     print "==========Different fields and their counts=========="
-    pprint.pprint(keys)   
+    pprint.pprint(keys)
+    print "==========Different fields and their estimated distinct values numbers=========="
+    pprint.pprint(cardinality)
+    print "==========Different fields and their sample values=========="
+    pprint.pprint(samples)
 
 if __name__ == "__main__":
     test()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+metrics.py measures where data.process_map() spends its time: cumulative seconds of every stage
+("parse", "audit", "prefilter", "shape", "clean", "filter", "geometry", "encode", "write"), elements/sec, bytes
+read and written and peak memory. A progress line is printed every PROGRESS_SECONDS and the final report is saved as
+json, so runs (for example in CI) can be compared.
+
+Stages are measured by wrapping the functions of each stage (timed(), timed_iter()), so nothing is
+measured and nothing is slowed down when metrics are not asked for.
+
+profiling() runs a block under cProfile, or under py-spy (https://github.com/benfred/py-spy) if it is
+installed, to look inside a slow stage.
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm', with_metrics=True)  # Saves shanghai_china.osm.metrics.json
+>>> data.process_map('shanghai_china.osm', profile='cprofile')  # Saves shanghai_china.osm.prof
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import pstats
+import signal
+import subprocess
+import time
+import compression
+import osmstream
+
+PROGRESS_SECONDS = 10 # Seconds between progress lines, None for no progress line
+PROGRESS_CHECK = 1000 # Elements between two looks at the clock
+PROFILE_LINES = 20 # Functions printed by cProfile
+
+class Metrics(object):
+    """
+    Counters of one conversion run.
+    """
+    def __init__(self, progress = True):
+        self.start = time.time()
+        self.stages = defaultdict(float)
+        self.elements = 0
+        self.admitted = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.shaped = 0 # Nodes and ways shaped
+        self.skipped = 0 # Nodes and ways not shaped, see data.is_uninformative()
+        self.progress_seconds = PROGRESS_SECONDS if progress else None
+        self.next_progress = self.start + (self.progress_seconds or 0)
+
+    def add(self, stage, seconds):
+        self.stages[stage] += seconds
+
+    def timed(self, func, stage):
+        """
+        Wrap a function so that time spent in it is added to a stage.
+        """
+        stages = self.stages
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages[stage] += time.time() - start
+        return wrapper
+
+    def timed_iter(self, iterable, stage):
+        """
+        Wrap an iterable so that time spent waiting for its items (for example parsing) is added to a stage.
+        """
+        stages = self.stages
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stages[stage] += time.time() - start
+                return
+            stages[stage] += time.time() - start
+            yield item
+
+    def tick(self):
+        """
+        Count one input element and print a progress line when it is time.
+        """
+        self.elements += 1
+        if self.progress_seconds and self.elements % PROGRESS_CHECK == 0 and time.time() >= self.next_progress:
+            print self.progress_line()
+            self.next_progress = time.time() + self.progress_seconds
+
+    def split(self, stage, part, seconds):
+        """
+        Move seconds of a stage into another stage, for example encoding time measured by a writer
+        out of the time of writer.write().
+        """
+        seconds = min(seconds, self.stages[stage])
+        self.stages[stage] -= seconds
+        self.stages[part] += seconds
+
+    def progress_line(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        total = sum(self.stages.values()) or 1e-9
+        shares = " ".join("{} {:.0%}".format(stage, seconds / total)
+                          for stage, seconds in sorted(self.stages.items(), key=lambda item: -item[1]))
+        return "=========Progress: {} elements, {:.0f} elements/sec, {:.1f} MB read, peak {} MB, {}".format(
+            self.elements, self.elements / elapsed, self.bytes_read / 1.0e6, osmstream.peak_rss_mb(), shares)
+
+    def report(self):
+        """
+        Returns:
+            dictionary: "elapsed_seconds", "elements", "admitted", "elements_per_sec", "bytes_read",
+                        "bytes_written", "peak_rss_mb", "stages" => stage => {"seconds", "share" of all stages},
+                        "skipped" => elements not shaped and "saved_seconds" => estimated time they would have
+                        taken to shape, clean and filter, less time spent deciding to skip
+        """
+        elapsed = time.time() - self.start
+        per_element = (sum(self.stages.get(stage, 0.0) for stage in ("shape", "clean", "filter")) /
+                       max(self.shaped, 1))
+        saved = self.skipped * per_element - self.stages.get("prefilter", 0.0)
+        return make_report(elapsed, self.elements, self.admitted, self.bytes_read, self.bytes_written,
+                           osmstream.peak_rss_mb(), self.stages, self.skipped, saved)
+
+def make_report(elapsed, elements, admitted, bytes_read, bytes_written, peak_rss_mb, stages, skipped = 0,
+                saved_seconds = 0.0):
+    total = sum(stages.values()) or 1e-9
+    return {"elapsed_seconds": elapsed,
+            "elements": elements,
+            "admitted": admitted,
+            "elements_per_sec": elements / max(elapsed, 1e-9),
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "peak_rss_mb": peak_rss_mb,
+            "skipped": skipped,
+            "saved_seconds": saved_seconds,
+            "stages": dict((stage, {"seconds": seconds, "share": seconds / total})
+                           for stage, seconds in stages.iteritems())}
+
+def merge_reports(reports, elapsed):
+    """
+    Merge reports of worker processes: counters and stage seconds are added up (so stage seconds are
+    process seconds, not wall time), elements/sec is computed on the given wall time.
+    """
+    stages = defaultdict(float)
+    for report in reports:
+        for stage, stats in report["stages"].iteritems():
+            stages[stage] += stats["seconds"]
+    peaks = [report["peak_rss_mb"] for report in reports if report["peak_rss_mb"] is not None]
+    return make_report(elapsed, sum(report["elements"] for report in reports),
+                       sum(report["admitted"] for report in reports),
+                       sum(report["bytes_read"] for report in reports),
+                       sum(report["bytes_written"] for report in reports),
+                       max(peaks) if peaks else None, stages, sum(report["skipped"] for report in reports),
+                       sum(report["saved_seconds"] for report in reports))
+
+def print_report(report):
+    print "=========Throughput is {:.0f} elements/sec, {:.1f} MB read, {:.1f} MB written".format(
+        report["elements_per_sec"], report["bytes_read"] / 1.0e6, report["bytes_written"] / 1.0e6)
+    print "=========Skipped {} uninformative elements before shaping, about {:.2f} s saved".format(
+        report["skipped"], report["saved_seconds"])
+    for stage, stats in sorted(report["stages"].iteritems(), key=lambda item: -item[1]["seconds"]):
+        print "=========Stage {}: {:.2f} s ({:.0%})".format(stage, stats["seconds"], stats["share"])
+
+def write_report(report, file_out):
+    with open(file_out, "w") as fo:
+        fo.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+class CountingReader(object):
+    """
+    File like object counting bytes read from another one into Metrics.bytes_read.
+    """
+    def __init__(self, f, metrics):
+        self.f = f
+        self.metrics = metrics
+
+    def read(self, size = -1):
+        data = self.f.read(size)
+        self.metrics.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+@contextmanager
+def profiling(kind, file_prefix):
+    """
+    Profile the current process while a block runs. Worker processes are not profiled.
+
+    Args:
+        param_1(string): None (no profiling), "cprofile" (statistics saved to "<prefix>.prof" and the slowest
+                         functions printed) or "py-spy" (flame graph saved to "<prefix>.svg", needs py-spy
+                         in PATH and the permission to attach to a process)
+        param_2(string): prefix of the profile file name
+    """
+    if kind is None:
+        yield
+    elif kind == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(file_prefix + ".prof")
+            pstats.Stats(profile).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    elif kind == "py-spy":
+        tool = compression.find_command(["py-spy"])
+        if tool is None:
+            raise OSError("py-spy is not installed")
+        proc = subprocess.Popen([tool, "record", "--pid", str(os.getpid()), "-o", file_prefix + ".svg"])
+        try:
+            yield
+        finally:
+            proc.send_signal(signal.SIGINT) # py-spy writes the flame graph when interrupted
+            proc.wait()
+    else:
+        raise ValueError("Unknown profiler {}".format(kind))
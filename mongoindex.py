@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+mongoindex.py builds the indexes used by the queries of import_mongodb_and_query.py, mongoupdate.py and
+spatial lookups, so that they do not scan the whole collection.
+
+Indexes are built after a bulk load (building them during the load would slow every insert down),
+with mongodb background option, optionally from a separate thread so that the caller does not wait.
+
+Note: "pos" is stored as [latitude, longitude] by data.shape_element(), while a 2dsphere index needs
+[longitude, latitude] pairs or GeoJSON, so the geospatial index on "pos" is a flat "2d" index.
+
+Usage:
+>>> python mongoindex.py
+"""
+import threading
+from pymongo import ASCENDING, GEO2D, IndexModel
+import mongoload
+
+INDEXES = [([("pos", GEO2D)], {"name": "pos_2d", "min": -180, "max": 180}),
+           ([("type", ASCENDING), ("id", ASCENDING)], {"name": "type_id"}), # Counts by type, updates by id
+           ([("created.user", ASCENDING)], {"name": "created_user"}),
+           ([("amenity", ASCENDING)], {"name": "amenity", "sparse": True}),
+           ([("address.postcode", ASCENDING)], {"name": "address_postcode", "sparse": True}),
+           ([("contact:phone", ASCENDING)], {"name": "contact_phone", "sparse": True})]
+
+def ensure_indexes(collection, background = True, wait = True):
+    """
+    Build all INDEXES (keys and options) on a collection, indexes already built are left as they are.
+
+    Args:
+        param_1(Collection): pymongo collection
+        param_2(boolean): let mongodb build indexes in background, without blocking other operations, default True
+        param_3(boolean): wait until indexes are built(True) or build them from another thread(False), default True
+    Returns:
+        list: names of built indexes if wait is True, otherwise the started thread
+    """
+    models = [IndexModel(keys, background=background, **options) for keys, options in INDEXES]
+    if wait:
+        names = collection.create_indexes(models)
+        print "=========Built indexes: {}".format(", ".join(names))
+        return names
+    thread = threading.Thread(target=collection.create_indexes, args=(models,))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def test():
+    ensure_indexes(mongoload.get_client('localhost:27017')['openStreetMap']['shanghai'])
+
+if __name__ == "__main__":
+    test()
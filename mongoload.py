@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+mongoload.py loads shaped open street map data directly into mongodb while data.process_map() converts it,
+so neither the intermediate json file nor mongoimport is needed.
+
+Shaped documents are grouped into batches and inserted with unordered insert_many() by a background thread,
+so xml parsing and inserting overlap. Number of inserted documents per second is printed at the end.
+
+Usage:
+>>> python mongoload.py
+"""
+from Queue import Queue
+import threading
+import time
+from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+import data
+import mongoindex
+import mongoreport
+import stats
+
+BATCH_SIZE = 1000 # Number of documents in one insert_many()
+QUEUE_SIZE = 4 # Number of batches waiting for insert, bound memory usage when mongodb is slower than parsing
+
+_clients = {}
+
+def get_client(host = 'localhost:27017', max_pool_size = 10):
+    """
+    Get a MongoClient for a host, only one client (with its connection pool) is created per host.
+    """
+    if host not in _clients:
+        _clients[host] = MongoClient(host, maxPoolSize=max_pool_size)
+    return _clients[host]
+
+class BulkWriter(object):
+    """
+    Writer of shaped elements for data.process_map() and data.convert_elements(), inserting them into
+    a mongodb collection in unordered batches from a background thread.
+
+    Args:
+        param_1(Collection): target pymongo collection
+        param_2(int): number of documents in one insert_many(), default BATCH_SIZE
+        param_3(int or string): write concern "w" option, for example 0, 1 or "majority", default 1
+    """
+    def __init__(self, collection, batch_size = BATCH_SIZE, w = 1):
+        self.collection = collection.with_options(write_concern=WriteConcern(w=w))
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        self.error = None
+        self.start = time.time()
+        self.queue = Queue(QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._insert_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _insert_batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue # Drain queue so that producer is not blocked
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                self.count += len(batch)
+            except Exception as e:
+                self.error = e
+
+    def write(self, el):
+        if self.error is not None:
+            raise self.error
+        self.batch.append(el)
+        if len(self.batch) >= self.batch_size:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        """
+        Insert remaining documents and wait for background thread, raise first insert error if any.
+        """
+        if len(self.batch) != 0:
+            self.queue.put(self.batch)
+            self.batch = []
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def docs_per_sec(self):
+        """
+        Returns:
+            float: number of inserted documents per second since writer was created
+        """
+        return self.count / max(time.time() - self.start, 1e-9)
+
+def load_map(file_in, db_name, collection, host = 'localhost:27017', batch_size = BATCH_SIZE, w = 1,
+             drop = True, build_indexes = True, **kwargs):
+    """
+    Convert a xml file with data.process_map() and insert shaped data directly into a mongodb collection.
+
+    Args:
+        param_1(string): input xml file name
+        param_2(string): database name
+        param_3(string): collection name
+        param_4(string): mongodb host, default 'localhost:27017'
+        param_5(int): number of documents in one insert_many(), default BATCH_SIZE
+        param_6(int or string): write concern "w" option, default 1
+        param_7(boolean): drop collection before loading, default True
+        param_8(boolean): build mongoindex.INDEXES in background once all documents are inserted, default True
+        Other keyword arguments are passed to data.process_map(). With with_stats=True, summary rollups are also
+        saved to the stats.STATS_COLLECTION of the database.
+    Returns:
+        int: number of inserted documents
+    """
+    db = get_client(host)[db_name]
+    if drop:
+        db[collection].drop()
+    writer = BulkWriter(db[collection], batch_size, w)
+    data.process_map(file_in, writer=writer, **kwargs)
+    mongoreport.bump_generation(db, collection)
+    if kwargs.get("with_stats"):
+        stats.save_to_collection(stats.load_report("{0}.stats.json".format(file_in)), db, collection)
+    print "=========Inserted {} documents, {:.0f} docs/sec".format(writer.count, writer.docs_per_sec())
+    if build_indexes: # Built after loading, maintaining them during inserts would slow loading down
+        mongoindex.ensure_indexes(db[collection])
+    return writer.count
+
+def test():
+    load_map('shanghai_china.osm', 'openStreetMap', 'shanghai')
+
+if __name__ == "__main__":
+    test()
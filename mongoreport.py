@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+mongoreport.py runs the count, distinct and aggregate queries of import_mongodb_and_query.py concurrently from
+a pool of threads (pymongo clients are thread safe and pool their connections), and caches their results.
+
+Cached results are keyed by collection and its load generation, a counter increased by every load or update
+(mongoload.load_map(), mongoupdate.apply_changes() and sync_map(), or bump_generation() after mongoimport).
+Repeated reports hit mongodb again only once the data has been reloaded: the generation itself is read at most
+every GENERATION_SECONDS. Latency of every query is measured and printed.
+
+Usage:
+>>> import mongoload, mongoreport
+>>> runner = mongoreport.ReportRunner(mongoload.get_client()['openStreetMap'], 'shanghai')
+>>> results = runner.run()
+>>> runner.print_timings()
+"""
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+from pymongo import ReturnDocument
+import mongoload
+
+WORKERS = 4 # Queries running at once
+GENERATION_SECONDS = 5 # Seconds a load generation read from mongodb is trusted
+GENERATION_COLLECTION = "load_generation"
+
+# Report queries, name => function(collection) returning a list or a number
+QUERIES = [("records", lambda c: c.find().count()),
+           ("users", lambda c: len(c.find().distinct("created.user"))),
+           ("nodes", lambda c: c.find({'type': 'node'}).count()),
+           ("ways", lambda c: c.find({'type': 'way'}).count()),
+           ("postcode_values", lambda c: list(c.find().distinct("address.postcode"))),
+           ("phone_values", lambda c: list(c.find().distinct("contact:phone"))),
+           ("amenity_top", lambda c: list(c.aggregate([
+               {"$match": {"amenity": {"$exists": 1}}},
+               {"$group": {"_id": "$amenity", "count": {"$sum": 1}}},
+               {"$sort": {"count": -1}},
+               {"$limit": 3}]))),
+           ("amenity_frequency", lambda c: list(c.aggregate([
+               {"$group": {"_id": "$amenity", "count": {"$sum": 1}}},
+               {"$group": {"_id": "$count", "num_amenity": {"$sum": 1}}},
+               {"$sort": {"_id": 1}},
+               {"$limit": 1}])))]
+QUERY_NAMES = [name for name, _ in QUERIES]
+
+def bump_generation(db, collection):
+    """
+    Record that the data of a collection changed, so cached report results are not used any more.
+
+    Returns:
+        int: new load generation
+    """
+    doc = db[GENERATION_COLLECTION].find_one_and_update({"_id": collection}, {"$inc": {"generation": 1}},
+                                                        upsert=True, return_document=ReturnDocument.AFTER)
+    return doc["generation"]
+
+def get_generation(db, collection):
+    doc = db[GENERATION_COLLECTION].find_one({"_id": collection})
+    return doc["generation"] if doc else 0
+
+def summary_results(summary):
+    """
+    Results of QUERIES found in a report of stats.SummaryStats, values not counted exactly are left out.
+    """
+    rst = dict((name, summary[name]) for name in QUERY_NAMES if summary.get(name) is not None)
+    if "amenity_frequency" in rst:
+        rst["amenity_frequency"] = rst["amenity_frequency"][:1]
+    return rst
+
+class ReportRunner(object):
+    """
+    Run report queries of one collection concurrently and cache their results by load generation.
+
+    Args:
+        param_1(Database): pymongo database
+        param_2(string): collection name
+        param_3(int): number of queries running at once, default WORKERS
+    """
+    _cache = {} # (database, collection, generation, query name) => result, shared by runners, only the latest
+                # generation seen of every collection is kept
+    _lock = threading.Lock()
+
+    def __init__(self, db, collection, workers = WORKERS):
+        self.db = db
+        self.collection = collection
+        self.workers = workers
+        self.generation = None
+        self.generation_time = 0
+        self.timings = {} # Query name => {"seconds": latency, "cached": whether result came from cache}
+
+    def current_generation(self):
+        if self.generation is None or time.time() - self.generation_time >= GENERATION_SECONDS:
+            self.generation = get_generation(self.db, self.collection)
+            self.generation_time = time.time()
+        return self.generation
+
+    def _run_query(self, job):
+        name, func = job
+        start = time.time()
+        result = func(self.db[self.collection])
+        return name, result, time.time() - start
+
+    def run(self, names = None):
+        """
+        Get results of report queries, from cache or by running the missing ones at once.
+
+        Args:
+            param_1(list): names of QUERIES to run, default all of them
+        Returns:
+            dictionary: query name => result
+        """
+        if names is None:
+            names = QUERY_NAMES
+        generation = self.current_generation()
+        rst = {}
+        jobs = []
+        with self._lock:
+            self._evict(generation)
+            for name, func in QUERIES:
+                if name not in names:
+                    continue
+                key = (self.db.name, self.collection, generation, name)
+                if key in self._cache:
+                    rst[name] = self._cache[key]
+                    self.timings[name] = {"seconds": 0.0, "cached": True}
+                else:
+                    jobs.append((name, func))
+        if jobs:
+            pool = ThreadPool(min(self.workers, len(jobs)))
+            try:
+                results = pool.map(self._run_query, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            with self._lock:
+                for name, result, seconds in results:
+                    self._cache[(self.db.name, self.collection, generation, name)] = result
+                    rst[name] = result
+                    self.timings[name] = {"seconds": seconds, "cached": False}
+        return rst
+
+    def _evict(self, generation):
+        """
+        Drop cached results of generations of the collection older than a given one, lock must be held.
+        """
+        for key in [key for key in self._cache
+                    if key[0] == self.db.name and key[1] == self.collection and key[2] < generation]:
+            del self._cache[key]
+
+    def print_timings(self):
+        for name in QUERY_NAMES:
+            if name in self.timings:
+                timing = self.timings[name]
+                print "=========Query {}: {:.3f} s{}".format(name, timing["seconds"],
+                                                             " (cached)" if timing["cached"] else "")
+
+def test():
+    runner = ReportRunner(mongoload.get_client('localhost:27017')['openStreetMap'], 'shanghai')
+    for name, result in sorted(runner.run().iteritems()):
+        print name, result
+    runner.print_timings()
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+mongoupdate.py updates an already loaded collection in place instead of dropping and reimporting it.
+
+Two ways are supported:
+- apply_changes() applies an OSM change file (.osc, "osmChange" format) with its "create", "modify" and
+  "delete" sections;
+- sync_map() compares a whole new extract with the collection using element "id" and "created.version",
+  only new or changed nodes and ways are written and the ones not in the new extract are deleted.
+
+Both shape elements exactly as data.process_map() does, so updated documents are the same as reimported ones,
+and report how many documents have been inserted, updated and deleted.
+
+Usage:
+>>> python mongoupdate.py shanghai_china.osc
+"""
+import sys
+from pymongo import DeleteOne, ReplaceOne
+import data
+import mongoload
+import mongoreport
+import osmstream
+
+BATCH_SIZE = 1000 # Number of operations in one bulk_write()
+
+class ChangeWriter(object):
+    """
+    Group upserts and deletes of shaped elements into ordered bulk_write() batches and count their results.
+    Documents are matched on "type" and "id", as ids of nodes and ways are not unique between each other.
+    """
+    def __init__(self, collection, batch_size = BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ops = []
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+
+    def upsert(self, el):
+        self.ops.append(ReplaceOne({'type': el['type'], 'id': el['id']}, el, upsert=True))
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def delete(self, el_type, el_id):
+        self.ops.append(DeleteOne({'type': el_type, 'id': el_id}))
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.ops) == 0:
+            return
+        result = self.collection.bulk_write(self.ops, ordered=True) # Same element may be changed twice
+        self.inserted += result.upserted_count
+        self.updated += result.modified_count
+        self.deleted += result.deleted_count
+        self.ops = []
+
+    def report(self):
+        self.flush()
+        print "=========Inserted {} documents".format(self.inserted)
+        print "=========Updated {} documents".format(self.updated)
+        print "=========Deleted {} documents".format(self.deleted)
+        return self.inserted, self.updated, self.deleted
+
+def apply_changes(osc_file, collection, batch_size = BATCH_SIZE):
+    """
+    Apply an OSM change file to a collection loaded from data.process_map() output.
+    Created or modified elements are upserted if they are informative (see data.isInfo()), otherwise they are
+    deleted as they would not be in a full reimport. Deleted elements are deleted.
+
+    Args:
+        param_1(string): input osmChange xml file name
+        param_2(Collection): pymongo collection to update
+        param_3(int): number of operations in one bulk_write(), default BATCH_SIZE
+    Returns:
+        tuple: (number of inserted, updated, deleted documents)
+    """
+    writer = ChangeWriter(collection, batch_size)
+    action = None
+    for event, element in osmstream.iterparse_stream(osc_file, events=("start", "end"), level=2):
+        if event == "start":
+            if element.tag in ("create", "modify", "delete"):
+                action = element.tag
+            continue
+        if element.tag != "node" and element.tag != "way":
+            continue
+        if action == "delete":
+            writer.delete(element.tag, element.attrib['id'])
+            continue
+        el = data.shape_element(element)
+        if data.isInfo(el):
+            writer.upsert(el)
+        else:
+            writer.delete(el['type'], el['id'])
+    rst = writer.report()
+    mongoreport.bump_generation(collection.database, collection.name)
+    return rst
+
+def sync_map(file_in, collection, batch_size = BATCH_SIZE):
+    """
+    Update a collection loaded from an older extract to a new extract of the same region.
+    Only documents whose "created.version" changed (or which are new) are written, documents whose
+    element is no more in the new extract (or is no more informative) are deleted.
+
+    Args:
+        param_1(string): input xml file name of new extract
+        param_2(Collection): pymongo collection to update
+        param_3(int): number of operations in one bulk_write(), default BATCH_SIZE
+    Returns:
+        tuple: (number of inserted, updated, deleted documents)
+    """
+    versions = {}
+    for doc in collection.find({}, {'_id': 0, 'type': 1, 'id': 1, 'created.version': 1}):
+        versions[(doc['type'], doc['id'])] = doc.get('created', {}).get('version')
+    writer = ChangeWriter(collection, batch_size)
+    for _, element in osmstream.iterparse_stream(file_in):
+        if element.tag != "node" and element.tag != "way":
+            continue
+        el = data.shape_element(element)
+        if not data.isInfo(el):
+            continue # Still in versions if it was loaded before, so it is deleted at the end
+        key = (el['type'], el['id'])
+        version = versions.pop(key, None)
+        if version is None or version != el.get('created', {}).get('version'):
+            writer.upsert(el)
+    for el_type, el_id in versions: # Not seen in new extract
+        writer.delete(el_type, el_id)
+    rst = writer.report()
+    mongoreport.bump_generation(collection.database, collection.name)
+    return rst
+
+def test():
+    db = mongoload.get_client('localhost:27017')['openStreetMap']
+    apply_changes(sys.argv[1], db['shanghai'])
+
+if __name__ == "__main__":
+    test()
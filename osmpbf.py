@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+osmpbf.py reads open street map PBF files (.osm.pbf) without expanding them to xml first.
+
+A PBF file is a sequence of blobs, each one a zlib compressed protocol buffer block of nodes (usually
+"dense" nodes), ways or relations. Blocks are decoded here with a small protocol buffer reader (no extra
+dependency) into the same elements and events as the xml backends of osmstream.py: an OsmElement per node,
+way and relation with the attributes of the xml file, "tag", "nd" and "member" sub elements, all inside
+an "osm" root element. So data.shape_element(), audit.py and mapparser.py work on them unchanged.
+
+Blobs are independent of each other, so a file is split into shards of blobs (see blob_shards()) which
+data.process_map() decodes in parallel worker processes.
+
+Usage:
+>>> import osmstream
+>>> for _, element in osmstream.iterparse_stream('shanghai_china.osm.pbf'):
+...     do_something(element)
+"""
+from datetime import datetime
+import struct
+import zlib
+import osmstream
+
+MEMBER_TYPES = ["node", "way", "relation"]
+
+def is_pbf(source):
+    """
+    Check whether a file name is a PBF file.
+    """
+    return isinstance(source, basestring) and source.endswith(".pbf")
+
+def _varint(buf, pos):
+    """
+    Decode a varint at pos of a bytearray, return (value, next pos).
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def _signed(n):
+    """
+    Two's complement of a 64 bits varint (int32 and int64 fields).
+    """
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def _zigzag(n):
+    """
+    Decode a sint32 or sint64 varint.
+    """
+    return (n >> 1) ^ -(n & 1)
+
+def _fields(data):
+    """
+    Decode a protocol buffer message.
+
+    Returns:
+        generator: (field number, value) pairs, value is an int for varint fields and a bytearray
+                   for length delimited fields (strings, sub messages, packed arrays)
+    """
+    buf = bytearray(data)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos+size]
+            pos += size
+        elif wire_type == 1:
+            value = struct.unpack("<q", bytes(buf[pos:pos+8]))[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack("<i", bytes(buf[pos:pos+4]))[0]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protocol buffer wire type {}".format(wire_type))
+        yield key >> 3, value
+
+def _packed(buf):
+    """
+    Decode a packed array of varints.
+    """
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+def _delta(values):
+    """
+    Decode a delta coded array of sint64.
+    """
+    rst = []
+    last = 0
+    for value in values:
+        last += _zigzag(value)
+        rst.append(last)
+    return rst
+
+def _text(data):
+    """
+    Decode a string of string table, same types as xml parsers: str if ascii, unicode otherwise.
+    """
+    value = bytes(data)
+    try:
+        return value.decode("ascii").encode("ascii")
+    except UnicodeDecodeError:
+        return value.decode("utf-8")
+
+class Block(object):
+    """
+    Settings of a PrimitiveBlock needed to decode its elements.
+    """
+    def __init__(self):
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+
+    def coordinate(self, offset, value):
+        return "{:.7f}".format(1e-9 * (offset + self.granularity * value))
+
+    def timestamp(self, value):
+        seconds = value * self.date_granularity // 1000
+        return datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _element(tag, block, el_id, info, lat = None, lon = None):
+    """
+    Build an OsmElement with attributes in the order of xml files. info is a dictionary of Info fields.
+    """
+    attrib = {}
+    attrib["id"] = str(el_id)
+    if "visible" in info:
+        attrib["visible"] = "true" if info["visible"] else "false"
+    if "version" in info:
+        attrib["version"] = str(info["version"])
+    if "changeset" in info:
+        attrib["changeset"] = str(info["changeset"])
+    if "timestamp" in info:
+        attrib["timestamp"] = block.timestamp(info["timestamp"])
+    if "user" in info and info["user"] != "":
+        attrib["user"] = info["user"]
+    if "uid" in info:
+        attrib["uid"] = str(info["uid"])
+    if lat is not None:
+        attrib["lat"] = block.coordinate(block.lat_offset, lat)
+        attrib["lon"] = block.coordinate(block.lon_offset, lon)
+    return osmstream.OsmElement(tag, attrib)
+
+def _add_tags(elem, block, keys, vals):
+    for k, v in zip(keys, vals):
+        elem.children.append(osmstream.OsmElement("tag", {"k": block.strings[k], "v": block.strings[v]}))
+
+def _info(data, block):
+    info = {}
+    for field, value in _fields(data):
+        if field == 1:
+            info["version"] = _signed(value)
+        elif field == 2:
+            info["timestamp"] = _signed(value)
+        elif field == 3:
+            info["changeset"] = _signed(value)
+        elif field == 4:
+            info["uid"] = _signed(value)
+        elif field == 5:
+            info["user"] = block.strings[value]
+        elif field == 6:
+            info["visible"] = bool(value)
+    return info
+
+def _node(data, block):
+    el_id, lat, lon, keys, vals, info = 0, 0, 0, [], [], {}
+    for field, value in _fields(data):
+        if field == 1:
+            el_id = _zigzag(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = _info(value, block)
+        elif field == 8:
+            lat = _zigzag(value)
+        elif field == 9:
+            lon = _zigzag(value)
+    elem = _element("node", block, el_id, info, lat, lon)
+    _add_tags(elem, block, keys, vals)
+    return elem
+
+def _dense_nodes(data, block):
+    ids, lats, lons, keys_vals, infos = [], [], [], [], {}
+    for field, value in _fields(data):
+        if field == 1:
+            ids = _delta(_packed(value))
+        elif field == 5:
+            for info_field, info_value in _fields(value):
+                if info_field == 1:
+                    infos["version"] = [_signed(v) for v in _packed(info_value)]
+                elif info_field == 2:
+                    infos["timestamp"] = _delta(_packed(info_value))
+                elif info_field == 3:
+                    infos["changeset"] = _delta(_packed(info_value))
+                elif info_field == 4:
+                    infos["uid"] = _delta(_packed(info_value))
+                elif info_field == 5:
+                    infos["user"] = [block.strings[sid] for sid in _delta(_packed(info_value))]
+                elif info_field == 6:
+                    infos["visible"] = [bool(v) for v in _packed(info_value)]
+        elif field == 8:
+            lats = _delta(_packed(value))
+        elif field == 9:
+            lons = _delta(_packed(value))
+        elif field == 10:
+            keys_vals = [_signed(v) for v in _packed(value)]
+    pos = 0
+    for n in range(len(ids)):
+        info = dict((key, values[n]) for key, values in infos.iteritems())
+        elem = _element("node", block, ids[n], info, lats[n], lons[n])
+        while pos < len(keys_vals) and keys_vals[pos] != 0: # Tags of each node end with 0
+            elem.children.append(osmstream.OsmElement("tag", {"k": block.strings[keys_vals[pos]],
+                                                              "v": block.strings[keys_vals[pos+1]]}))
+            pos += 2
+        pos += 1
+        yield elem
+
+def _way(data, block):
+    el_id, keys, vals, info, refs = 0, [], [], {}, []
+    for field, value in _fields(data):
+        if field == 1:
+            el_id = _signed(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = _info(value, block)
+        elif field == 8:
+            refs = _delta(_packed(value))
+    elem = _element("way", block, el_id, info)
+    for ref in refs:
+        elem.children.append(osmstream.OsmElement("nd", {"ref": str(ref)}))
+    _add_tags(elem, block, keys, vals)
+    return elem
+
+def _relation(data, block):
+    el_id, keys, vals, info, roles, memids, types = 0, [], [], {}, [], [], []
+    for field, value in _fields(data):
+        if field == 1:
+            el_id = _signed(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = _info(value, block)
+        elif field == 8:
+            roles = [_signed(v) for v in _packed(value)]
+        elif field == 9:
+            memids = _delta(_packed(value))
+        elif field == 10:
+            types = _packed(value)
+    elem = _element("relation", block, el_id, info)
+    for role, memid, member_type in zip(roles, memids, types):
+        elem.children.append(osmstream.OsmElement("member", {"type": MEMBER_TYPES[member_type], "ref": str(memid),
+                                                             "role": block.strings[role]}))
+    _add_tags(elem, block, keys, vals)
+    return elem
+
+def _primitive_block(data):
+    """
+    Decode all elements of an OSMData block.
+    """
+    block = Block()
+    groups = []
+    for field, value in _fields(data):
+        if field == 1:
+            block.strings = [_text(s) for _, s in _fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block.granularity = value
+        elif field == 18:
+            block.date_granularity = value
+        elif field == 19:
+            block.lat_offset = _signed(value)
+        elif field == 20:
+            block.lon_offset = _signed(value)
+    for group in groups:
+        for field, value in _fields(group):
+            if field == 1:
+                yield _node(value, block)
+            elif field == 2:
+                for elem in _dense_nodes(value, block):
+                    yield elem
+            elif field == 3:
+                yield _way(value, block)
+            elif field == 4:
+                yield _relation(value, block)
+
+def _header_block(data):
+    """
+    Decode bounding box of an OSMHeader block into a "bounds" element, None if there is none.
+    """
+    for field, value in _fields(data):
+        if field == 1:
+            box = dict((f, _zigzag(v)) for f, v in _fields(value)) # left, right, top, bottom in nanodegrees
+            return osmstream.OsmElement("bounds", {"minlat": "{:.7f}".format(box.get(4, 0) * 1e-9),
+                                                   "minlon": "{:.7f}".format(box.get(1, 0) * 1e-9),
+                                                   "maxlat": "{:.7f}".format(box.get(3, 0) * 1e-9),
+                                                   "maxlon": "{:.7f}".format(box.get(2, 0) * 1e-9)})
+    return None
+
+def _read_blob_header(f):
+    """
+    Read the header of next blob, return (blob type, blob size), None at end of file.
+    """
+    size = f.read(4)
+    if len(size) < 4:
+        return None
+    header = dict(_fields(f.read(struct.unpack(">I", size)[0])))
+    return bytes(header[1]), header[3]
+
+def _blob_data(data):
+    blob = dict(_fields(data))
+    if 1 in blob:
+        return bytes(blob[1])
+    if 3 in blob:
+        return zlib.decompress(bytes(blob[3]))
+    raise ValueError("Unsupported PBF blob compression, only raw and zlib blobs can be read")
+
+def blob_offsets(filename):
+    """
+    Offsets of all blobs of a PBF file (headers only are read), followed by file size.
+    """
+    offsets = []
+    with open(filename, "rb") as f:
+        while True:
+            offset = f.tell()
+            header = _read_blob_header(f)
+            if header is None:
+                offsets.append(offset)
+                return offsets
+            offsets.append(offset)
+            f.seek(header[1], 1)
+
+def blob_shards(filename, num_shards):
+    """
+    Split a PBF file into shards of whole blobs, same format as osmstream.shard_offsets().
+
+    Returns:
+        list: (start, end) byte offsets of non empty shards, in file order
+    """
+    offsets = blob_offsets(filename)
+    num_blobs = len(offsets) - 1
+    bounds = [offsets[num_blobs * i // num_shards] for i in range(num_shards)] + [offsets[-1]]
+    return [(bounds[i], bounds[i+1]) for i in range(num_shards) if bounds[i] < bounds[i+1]]
+
+def iter_elements(filename, start = 0, end = None):
+    """
+    Decode elements of the blobs of a PBF file between two offsets (whole file by default).
+
+    Returns:
+        generator: "bounds", "node", "way" and "relation" OsmElements in file order
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            header = _read_blob_header(f)
+            if header is None:
+                return
+            blob_type, size = header
+            data = _blob_data(f.read(size))
+            if blob_type == "OSMHeader":
+                bounds = _header_block(data)
+                if bounds is not None:
+                    yield bounds
+            elif blob_type == "OSMData":
+                for elem in _primitive_block(data):
+                    yield elem
+
+def iterparse(filename, start = 0, end = None):
+    """
+    Same events as xml backends of osmstream.py for the elements of iter_elements(), with sub elements
+    and a root "osm" element, so that a PBF file can be given to osmstream.iterparse_stream().
+
+    Returns:
+        generator: ("start" or "end", element) pairs
+    """
+    root = osmstream.OsmElement("osm", {"version": "0.6"})
+    yield "start", root
+    for elem in iter_elements(filename, start, end):
+        root.children.append(elem)
+        yield "start", elem
+        for child in elem.children:
+            yield "start", child
+            yield "end", child
+        yield "end", elem
+    yield "end", root
+
+def _encode_varint(n):
+    """
+    Encode a varint, only used by test() to build a PBF block.
+    """
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def _encode_field(field, data):
+    return _encode_varint((field << 3) | 2) + _encode_varint(len(data)) + data
+
+def _encode_packed(values, zigzag = True):
+    return "".join(_encode_varint(_zigzag_encode(v) if zigzag else v) for v in values)
+
+def _zigzag_encode(n):
+    return (n << 1) ^ (n >> 63)
+
+def test():
+    # A block of dense nodes without metadata: attributes are only id, lat and lon, "pos" must still be
+    # [latitude, longitude]
+    import data
+    strings = _encode_field(1, "") + _encode_field(1, "amenity") + _encode_field(1, "cafe")
+    dense = (_encode_field(1, _encode_packed([1, 1])) +                             # ids 1, 2
+             _encode_field(8, _encode_packed([311000000, 100000])) +               # latitudes 31.1, 31.11
+             _encode_field(9, _encode_packed([1211000000, 100000])) +              # longitudes 121.1, 121.11
+             _encode_field(10, _encode_packed([1, 2, 0, 0], zigzag=False)))         # amenity=cafe on node 1
+    block = _encode_field(1, strings) + _encode_field(2, _encode_field(2, dense))
+    nodes = list(_primitive_block(block))
+    assert [node.attrib["id"] for node in nodes] == ["1", "2"]
+    shaped = data.shape_element(nodes[0])
+    assert shaped["pos"] == [31.1, 121.1], shaped["pos"]
+    assert shaped["amenity"] == "cafe"
+    assert data.shape_element(nodes[1])["pos"] == [31.11, 121.11]
+    print shaped
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+osmstream.py contains helpers shared by the scripts which read the open street map xml file,
+so that a big extract (a whole country, not only Shanghai) can be parsed with bounded memory.
+
+ET.iterparse() builds the whole tree while it is reading, so every "node" and "way" element
+stays alive under the root "osm" element until the end of the file. iterparse_stream() clears
+every top level element as soon as its "end" event has been consumed and drops it from the root.
+
+The xml parser behind iterparse_stream() can be chosen by setting environment variable OSM_PARSER
+(or osmstream.BACKEND) to one of BACKENDS:
+- "etree": xml.etree.cElementTree, default;
+- "lxml": lxml.etree, if lxml is installed;
+- "expat": xml.parsers.expat handlers building lightweight OsmElement records instead of a tree.
+Open street map PBF files (name ending with ".pbf") are decoded by osmpbf.py whatever the backend.
+Compressed xml files (name ending with ".gz", ".bz2", ".xz" or ".zst") are decompressed by compression.py
+in another process or thread while they are parsed.
+All backends give the same events and elements with the same tag, attrib, get(), findall() and iter(),
+run benchmark_backends() to compare their elements/sec on a file.
+
+Usage:
+>>> python osmstream.py  # Compare backends on shanghai_china.osm
+>>> import osmstream
+>>> for _, element in osmstream.iterparse_stream('shanghai_china.osm'):
+...     do_something(element)
+"""
+import os
+import re
+import sys
+import time
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+try:
+    import resource
+except ImportError: # resource module only exists on Unix
+    resource = None
+try:
+    from lxml import etree as lxml_etree
+except ImportError: # lxml backend is optional
+    lxml_etree = None
+import compression
+import osmpbf
+
+RSS_CHECK_INTERVAL = 10000 # Check memory usage every 10000 records, same as the progress output
+READ_SIZE = 65536 # Bytes read at once by expat backend
+BACKEND = os.environ.get("OSM_PARSER", "etree")
+
+class OsmElement(object):
+    """
+    Lightweight element built by expat backend, with the part of ElementTree element interface
+    used on open street map data (no text, no tail).
+    """
+    __slots__ = ("tag", "attrib", "children")
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+
+    def __len__(self):
+        return len(self.children)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def findall(self, tag):
+        return [child for child in self.children if child.tag == tag]
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            for elem in child.iter(tag):
+                yield elem
+
+    def clear(self):
+        self.attrib = {}
+        self.children = []
+
+def _iterparse_etree(source):
+    return ET.iterparse(source, events=("start", "end"))
+
+def _iterparse_lxml(source):
+    if lxml_etree is None:
+        raise ImportError("lxml is not installed, OSM_PARSER=lxml cannot be used")
+    return lxml_etree.iterparse(source, events=("start", "end"))
+
+def _iterparse_expat(source):
+    f = open(source, "rb") if isinstance(source, basestring) else source
+    events = []
+    parents = []
+    def start(tag, attrib):
+        elem = OsmElement(tag, attrib)
+        if parents:
+            parents[-1].children.append(elem)
+        parents.append(elem)
+        events.append(("start", elem))
+    def end(tag):
+        events.append(("end", parents.pop()))
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            parser.Parse(data, len(data) == 0)
+            for event in events:
+                yield event
+            del events[:]
+            if len(data) == 0:
+                break
+    finally:
+        if f is not source:
+            f.close()
+
+BACKENDS = {"etree": _iterparse_etree, "lxml": _iterparse_lxml, "expat": _iterparse_expat}
+
+def iterparse_stream(source, events=("end",), level=1, backend=None):
+    """
+    Same as ET.iterparse(), but release every top level element (node, way, relation, ...) and all
+    its sub tags after the caller has consumed its "end" event.
+
+    Note: a top level element is only complete at its "end" event, so callers must finish all work on
+    it (including its sub tags) before asking for the next item.
+
+    Args:
+        param_1(string or file): input xml file name (may be compressed) or file object, or PBF file name
+        param_2(tuple): events wanted by the caller, subset of ("start", "end"), default ("end",)
+        param_3(int): depth of released elements, default 1 (children of root). For example osmChange files
+                      keep nodes and ways inside "create", "modify" and "delete" elements, at depth 2.
+        param_4(string): xml parser, one of BACKENDS, default None (BACKEND)
+    Returns:
+        generator: (event, element) pairs as ET.iterparse()
+    """
+    if osmpbf.is_pbf(source):
+        raw_events = osmpbf.iterparse(source)
+    elif compression.compression_suffix(source):
+        raw_events = _closing(BACKENDS[backend or BACKEND], compression.open_input(source))
+    else:
+        raw_events = BACKENDS[backend or BACKEND](source)
+    return _release(raw_events, events, level)
+
+def _closing(parse, f):
+    """
+    Parse an opened file and close it once parsing ends or stops.
+    """
+    try:
+        for event in parse(f):
+            yield event
+    finally:
+        f.close()
+
+def _release(raw_events, events, level):
+    """
+    Pass wanted events of a parser on, and release elements at given depth once their "end" event is consumed.
+    """
+    parents = [] # Elements opened but not closed yet
+    for event, elem in raw_events:
+        if event == "start":
+            parents.append(elem)
+            if "start" in events:
+                yield event, elem
+        else:
+            parents.pop()
+            if "end" in events:
+                yield event, elem
+            if len(parents) == level: # Nothing will refer to it any more
+                elem.clear()
+                parents[-1].clear()
+
+def peak_rss_mb():
+    """
+    Get memory high-water mark (peak resident set size) of current process.
+
+    Returns:
+        float: peak memory usage in MB, None if it can not be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # Mac OS reports bytes, Linux reports kilobytes
+        return peak / 1.0e6
+    return peak / 1.0e3
+
+def check_rss_budget(max_rss_mb):
+    """
+    Stop the run if peak memory usage is beyond the given budget.
+
+    Args:
+        param_1(float): peak memory budget in MB, None means no limit
+    Returns:
+        None, raise MemoryError if budget is exceeded
+    """
+    if max_rss_mb is None:
+        return
+    peak = peak_rss_mb()
+    if peak is not None and peak > max_rss_mb:
+        raise MemoryError("Peak memory usage {:.1f} MB exceeds budget {} MB".format(peak, max_rss_mb))
+
+TOP_LEVEL_RE = re.compile(r'^\s*<(node|way|relation|bounds|bound|changeset)\b') # Elements right under root "osm"
+SHARD_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+SHARD_FOOTER = '</osm>\n'
+
+def _align_offset(f, offset, size):
+    """
+    Move a byte offset forward to the beginning of the next line which opens a top level element.
+    Return size if there is no such line after the offset.
+    """
+    f.seek(offset)
+    if offset > 0:
+        f.readline() # Skip partial line, it belongs to previous shard
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line or line.lstrip().startswith("</osm"):
+            return size
+        if TOP_LEVEL_RE.match(line):
+            return pos
+
+def shard_offsets(filename, num_shards):
+    """
+    Split a xml file into byte range shards. Every shard begins at a line opening a top level element,
+    so it can be parsed on its own once wrapped in a root element (see ShardReader).
+
+    Note: this relies on the usual open street map file layout of one element start per line,
+    an empty list is returned when no such line is found, or when the file is compressed.
+
+    Args:
+        param_1(string): input xml file name
+        param_2(int): wanted number of shards
+    Returns:
+        list: (start, end) byte offsets of non empty shards, in file order
+    """
+    if osmpbf.is_pbf(filename): # PBF files are split on blob boundaries
+        return osmpbf.blob_shards(filename, num_shards)
+    if compression.compression_suffix(filename): # Compressed streams cannot be read from an offset
+        return []
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        bounds = [_align_offset(f, size * i // num_shards, size) for i in range(num_shards)]
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(num_shards) if bounds[i] < bounds[i+1]]
+
+def iterparse_shard(filename, start, end):
+    """
+    Stream elements of a shard of shard_offsets() as iterparse_stream(), inside a synthetic "osm" root element.
+    """
+    if osmpbf.is_pbf(filename):
+        return _release(osmpbf.iterparse(filename, start, end), ("end",), 1)
+    return iterparse_stream(ShardReader(filename, start, end))
+
+class ShardReader(object):
+    """
+    File like object reading the byte range [start, end) of a xml file wrapped in a synthetic "osm" root,
+    it can be given to ET.iterparse() or iterparse_stream() directly. Reading stops at closing "osm" tag.
+    """
+    def __init__(self, filename, start, end):
+        self.f = open(filename, "rb")
+        self.f.seek(start)
+        self.remain = end - start
+        self.pending = SHARD_HEADER
+        self.done = False
+
+    def read(self, size=65536):
+        while len(self.pending) < size and not self.done:
+            line = self.f.readline() if self.remain > 0 else ""
+            self.remain -= len(line)
+            if not line or line.lstrip().startswith("</osm"):
+                self.pending += SHARD_FOOTER
+                self.done = True
+                self.f.close()
+            else:
+                self.pending += line
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+def benchmark_backends(filename, backends=None):
+    """
+    Stream a whole file with every backend and compare their speed.
+
+    Args:
+        param_1(string): input xml file name
+        param_2(list): names of backends to compare, default None (all available BACKENDS)
+    Returns:
+        dictionary: Keys are backend names, values are elements per second
+    """
+    if backends is None:
+        backends = sorted(name for name in BACKENDS if name != "lxml" or lxml_etree is not None)
+    rst = {}
+    for name in backends:
+        count = 0
+        start = time.time()
+        for _, elem in iterparse_stream(filename, backend=name):
+            count += 1
+        rst[name] = count / max(time.time() - start, 1e-9)
+        print "{:>6}: {} elements, {:.0f} elements/sec".format(name, count, rst[name])
+    return rst
+
+def test():
+    benchmark_backends('shanghai_china.osm')
+
+if __name__ == "__main__":
+    test()
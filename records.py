@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+records.py contains compact record types of shaped nodes and ways, used by data.convert_elements() instead of
+the nested dictionaries of data.shape_element(). Most nodes of an extract only carry an id, a position and
+"created" attributes, so a record keeps them in slots:
+- attribute names ("id", "visible", ...) and "created" names are tuples shared by all records with the same
+  names, values are tuples;
+- "pos" is two floats and "node_refs" is an array of 64 bits ids instead of a list of strings;
+- tag fields and "address" are dictionaries only for elements which have tags, keyed by the key strings
+  compiled once by rules.TagRules.
+A record is turned into the dictionary of shape_element() (same keys, inserted in the same order, so json
+output is byte for byte the same) by to_dict(), only once it is known to be written.
+
+Records support what data.isInfo() and data.clean_elements() need from a shaped dictionary: keys(), "in",
+reading, setting and deleting fields and "address". data.isInfo() uses is_info() of records, which does not
+list their keys.
+"""
+from array import array
+import geometry
+
+_names = {} # Tuple of names => same tuple, shared by records
+
+def intern_names(names):
+    """
+    Get the shared tuple equal to a tuple of attribute names.
+    """
+    return _names.setdefault(names, names)
+
+class Record(object):
+    """
+    Shaped "node" or "way" element.
+
+    Args:
+        param_1(tuple): names of attributes other than "created" ones and coordinates, in element order,
+                        shared by intern_names()
+        param_2(tuple): their values
+        param_3(tuple): names of "created" attributes, in element order, shared by intern_names()
+        param_4(tuple): their values
+        param_5(float): lat, latitude (first value of "pos") given by name, None if element has no position
+        param_6(float): lon, longitude (second value of "pos") given by name
+    """
+    __slots__ = ("attr_names", "attr_values", "created_names", "created_values", "lat", "lon", "fields",
+                 "address", "address_dropped", "node_refs")
+    TYPE = None
+
+    def __init__(self, attr_names, attr_values, created_names, created_values, lat = None, lon = None):
+        self.attr_names = attr_names
+        self.attr_values = attr_values
+        self.created_names = created_names
+        self.created_values = created_values
+        self.lat = lat
+        self.lon = lon
+        self.fields = None # Attributes and tag fields once the element has tags, see tag_fields()
+        self.address = None
+        self.address_dropped = False # Emptied by cleaning
+        self.node_refs = None
+
+    def tag_fields(self):
+        """
+        Get the dictionary of top level fields to add tag fields to, starting with the attributes.
+        """
+        if self.fields is None:
+            self.fields = dict(zip(self.attr_names, self.attr_values))
+        return self.fields
+
+    def keys(self):
+        """
+        Keys of the dictionary of to_dict().
+        """
+        keys = list(self.fields if self.fields is not None else self.attr_names)
+        keys.append('type')
+        if self.node_refs:
+            keys.append('node_refs')
+        if self.address is not None:
+            keys.append('address')
+        if self.lat is not None:
+            keys.append('pos')
+        if self.created_names:
+            keys.append('created')
+        if self.fields is not None and len(keys) != len(set(keys)): # Tag fields named like the added keys
+            keys = list(set(keys))
+        return keys
+
+    def is_info(self, uninformative, flag):
+        """
+        Same as data.isInfo() of to_dict(), without building the dictionary: whether the record has a key which is
+        not one of given uninformative keys, and has no given flag.
+        """
+        if self.fields is not None:
+            if flag in self.fields:
+                return False
+            for key in self.fields:
+                if key not in uninformative:
+                    return True
+        elif has_other_names(self.attr_names, uninformative):
+            return True
+        return bool(self.node_refs) or self.address is not None
+
+    def __contains__(self, key):
+        if key == 'address' and self.address is not None:
+            return True
+        if self.fields is not None:
+            return key in self.fields
+        return key in self.attr_names
+
+    def __getitem__(self, key):
+        if key == 'address' and self.address is not None:
+            return self.address
+        if self.fields is not None:
+            return self.fields[key]
+        try:
+            return self.attr_values[self.attr_names.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.tag_fields()[key] = value
+
+    def __delitem__(self, key):
+        if key == 'address' and self.address is not None:
+            self.address = None
+            self.address_dropped = True
+        elif self.fields is None:
+            raise KeyError(key)
+        else:
+            del self.fields[key]
+
+    def to_dict(self):
+        """
+        Returns:
+            dictionary: same as data.shape_element() of the element. The record must not be used afterwards,
+                        its fields become the dictionary.
+        """
+        rst = self.fields if self.fields is not None else dict(zip(self.attr_names, self.attr_values))
+        rst['type'] = self.TYPE
+        if self.node_refs:
+            rst['node_refs'] = map(str, self.node_refs)
+        if self.address is not None:
+            rst['address'] = self.address
+        elif self.address_dropped: # Added and deleted again, as by shape_element(), for the same key order
+            rst['address'] = None
+        if self.lat is not None:
+            rst['pos'] = [self.lat, self.lon]
+        if self.created_names:
+            rst['created'] = dict(zip(self.created_names, self.created_values))
+        if self.address_dropped:
+            del rst['address']
+        return rst
+
+_informative_names = {} # (attribute names, uninformative keys) => whether one of the names is informative
+
+def has_other_names(names, uninformative):
+    """
+    Whether one of a tuple of attribute names is not in a frozenset of uninformative keys, computed once.
+    """
+    key = (names, uninformative)
+    rst = _informative_names.get(key)
+    if rst is None:
+        rst = _informative_names[key] = any(name not in uninformative for name in names)
+    return rst
+
+class Node(Record):
+    __slots__ = ()
+    TYPE = 'node'
+
+class Way(Record):
+    __slots__ = ()
+    TYPE = 'way'
+
+def node_refs_array(refs):
+    """
+    Pack "nd" references (strings) into an array of ids.
+    """
+    return array(geometry.ID_TYPE, map(int, refs))
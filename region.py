@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+region.py tells whether points are inside a region given by its boundary polygons, such as the administrative
+boundary of Shanghai saved as GeoJSON (for example exported from its OpenStreetMap relation). data.py uses it,
+through the "boundary" of rules.CleaningRules, to flag elements whose "pos" is outside the region, since most
+elements have no "addr:city" telling where they are and a bounding box extract has many points around the region.
+
+RegionGrid precomputes a grid over the bounding box of the polygons whose cells are inside, outside or on the
+edge of the region. Points of inside and outside cells are answered by one lookup, only points of edge cells
+are tested against the polygon, and only against the edges crossing their row of cells.
+
+Usage:
+>>> import region
+>>> grid = region.load_region('shanghai.geojson')
+>>> grid.contains(31.23, 121.47)
+True
+>>> python region.py
+"""
+import json
+import math
+import random
+import time
+
+GRID_CELLS = 512 # Cells along the longer side of the bounding box of the region
+OUTSIDE, INSIDE, EDGE = 0, 1, 2 # States of grid cells
+
+def geojson_polygons(obj):
+    """
+    Get polygons of a GeoJSON object: FeatureCollection, Feature, GeometryCollection, Polygon or MultiPolygon.
+    Other geometries have no polygon.
+
+    Args:
+        param_1(dictionary): GeoJSON object
+    Returns:
+        list: polygons, each a list of rings of (longitude, latitude) points, the first ring is the outer
+              boundary and the others are holes
+    """
+    kind = obj.get("type")
+    if kind == "FeatureCollection":
+        return [polygon for feature in obj["features"] for polygon in geojson_polygons(feature)]
+    if kind == "Feature":
+        return geojson_polygons(obj["geometry"]) if obj.get("geometry") else []
+    if kind == "GeometryCollection":
+        return [polygon for geometry in obj["geometries"] for polygon in geojson_polygons(geometry)]
+    if kind == "Polygon":
+        return [_rings(obj["coordinates"])]
+    if kind == "MultiPolygon":
+        return [_rings(coordinates) for coordinates in obj["coordinates"]]
+    return []
+
+def _rings(coordinates):
+    return [[(float(point[0]), float(point[1])) for point in ring] for ring in coordinates]
+
+def load_polygons(file_in):
+    """
+    Read polygons of a GeoJSON file, see geojson_polygons().
+    """
+    with open(file_in) as f:
+        polygons = geojson_polygons(json.load(f))
+    if not polygons:
+        raise ValueError("No polygon in {}".format(file_in))
+    return polygons
+
+def polygon_edges(polygons):
+    """
+    Get edges (x1, y1, x2, y2) of all rings of polygons, rings are closed if they are not.
+    """
+    edges = []
+    for polygon in polygons:
+        for ring in polygon:
+            for i in range(len(ring)):
+                (x1, y1), (x2, y2) = ring[i - 1], ring[i]
+                if (x1, y1) != (x2, y2):
+                    edges.append((x1, y1, x2, y2))
+    return edges
+
+def crossing_test(edges, x, y):
+    """
+    Even-odd rule: whether a point is inside polygons given by their edges, holes included.
+    """
+    inside = False
+    for x1, y1, x2, y2 in edges:
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+class RegionGrid(object):
+    """
+    Point in polygon test precomputed on a grid of cells.
+
+    Args:
+        param_1(list): polygons of geojson_polygons()
+        param_2(int): number of cells along the longer side of the bounding box, default GRID_CELLS
+    """
+    def __init__(self, polygons, cells = GRID_CELLS):
+        self.edges = polygon_edges(polygons)
+        if not self.edges:
+            raise ValueError("Region has no edge")
+        xs = [x for edge in self.edges for x in (edge[0], edge[2])]
+        ys = [y for edge in self.edges for y in (edge[1], edge[3])]
+        self.min_lon, self.min_lat = min(xs), min(ys)
+        self.max_lon, self.max_lat = max(xs), max(ys)
+        self.cell_size = max(self.max_lon - self.min_lon, self.max_lat - self.min_lat) / cells
+        if self.cell_size <= 0:
+            raise ValueError("Region has an empty bounding box")
+        self.cols = int((self.max_lon - self.min_lon) / self.cell_size) + 1
+        self.rows = int((self.max_lat - self.min_lat) / self.cell_size) + 1
+        self.cells = bytearray(self.rows * self.cols) # OUTSIDE, INSIDE or EDGE of every cell, row by row
+        self.row_edges = [[] for _ in range(self.rows)] # Edges crossing every row
+        for edge in self.edges:
+            self._add_edge(edge)
+        for row in range(self.rows):
+            self._fill_row(row)
+
+    def _add_edge(self, edge):
+        """
+        Mark cells an edge goes through as EDGE, by pieces no longer than a cell (the bounding box of every
+        piece is marked, so a few cells next to the edge may be marked too, which only costs a full test).
+        """
+        x1, y1, x2, y2 = edge
+        size = self.cell_size
+        pad = size * 1e-6 # Points on a cell border belong to both cells
+        first = max(0, int((min(y1, y2) - self.min_lat - pad) / size))
+        last = min(self.rows - 1, int((max(y1, y2) - self.min_lat + pad) / size))
+        for row in range(first, last + 1):
+            self.row_edges[row].append(edge)
+        pieces = int(max(abs(x2 - x1), abs(y2 - y1)) / size) + 1
+        for i in range(pieces):
+            ax, ay = x1 + (x2 - x1) * i / pieces, y1 + (y2 - y1) * i / pieces
+            bx, by = x1 + (x2 - x1) * (i + 1) / pieces, y1 + (y2 - y1) * (i + 1) / pieces
+            col_from = max(0, int((min(ax, bx) - self.min_lon - pad) / size))
+            col_to = min(self.cols - 1, int((max(ax, bx) - self.min_lon + pad) / size))
+            row_from = max(0, int((min(ay, by) - self.min_lat - pad) / size))
+            row_to = min(self.rows - 1, int((max(ay, by) - self.min_lat + pad) / size))
+            for row in range(row_from, row_to + 1):
+                start = row * self.cols
+                for col in range(col_from, col_to + 1):
+                    self.cells[start + col] = EDGE
+
+    def _fill_row(self, row):
+        """
+        Mark other cells of a row INSIDE or OUTSIDE by the state of their centers, found by sweeping the line
+        through the centers from west to east: it is inside after an odd number of edges.
+        """
+        y = self.min_lat + (row + 0.5) * self.cell_size
+        crossings = sorted(x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+                           for x1, y1, x2, y2 in self.row_edges[row] if (y1 > y) != (y2 > y))
+        start = row * self.cols
+        crossed = 0
+        for col in range(self.cols):
+            x = self.min_lon + (col + 0.5) * self.cell_size
+            while crossed < len(crossings) and crossings[crossed] <= x:
+                crossed += 1
+            if self.cells[start + col] != EDGE:
+                self.cells[start + col] = INSIDE if crossed % 2 else OUTSIDE
+
+    def contains(self, lat, lon):
+        """
+        Whether a point ("pos" of data.py, latitude first) is inside the region.
+        """
+        if lat < self.min_lat or lon < self.min_lon:
+            return False
+        row = int((lat - self.min_lat) / self.cell_size)
+        col = int((lon - self.min_lon) / self.cell_size)
+        if row >= self.rows or col >= self.cols:
+            return False
+        state = self.cells[row * self.cols + col]
+        if state == EDGE:
+            return crossing_test(self.row_edges[row], lon, lat)
+        return state == INSIDE
+
+    def contains_exact(self, lat, lon):
+        """
+        Same as contains(), testing all edges of the polygons.
+        """
+        return crossing_test(self.edges, lon, lat)
+
+    def edge_share(self):
+        """
+        Share of the cells which are on the edge of the region.
+        """
+        return float(self.cells.count(chr(EDGE))) / len(self.cells)
+
+def load_region(file_in, cells = GRID_CELLS):
+    """
+    Build the RegionGrid of the polygons of a GeoJSON file.
+    """
+    return RegionGrid(load_polygons(file_in), cells)
+
+def test():
+    # A ragged ring of 2000 points around Shanghai with a hole, points are tested in its bounding box
+    random.seed(1)
+    ring = [(121.45 + math.cos(2 * math.pi * i / 2000) * 0.6 * random.uniform(0.8, 1.0),
+             31.2 + math.sin(2 * math.pi * i / 2000) * 0.5 * random.uniform(0.8, 1.0)) for i in range(2000)]
+    hole = [(121.45 + math.cos(2 * math.pi * i / 50) * 0.1, 31.2 + math.sin(2 * math.pi * i / 50) * 0.1)
+            for i in range(50)]
+    start = time.time()
+    grid = RegionGrid([[ring, hole]])
+    print "=========Built {}x{} grid in {:.2f} s, {:.1%} edge cells".format(grid.cols, grid.rows,
+                                                                          time.time() - start, grid.edge_share())
+    points = [(random.uniform(30.6, 31.8), random.uniform(120.7, 122.2)) for _ in range(20000)]
+    rst = {}
+    for name, func in [("grid", grid.contains), ("exact", grid.contains_exact)]:
+        start = time.time()
+        rst[name] = [func(lat, lon) for lat, lon in points]
+        print "{:>6}: {:.0f} points/sec".format(name, len(points) / (time.time() - start))
+    assert rst["grid"] == rst["exact"]
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+rules.py loads the cleaning rules shared by data.py and audit.py from a json config file, by default
+cleaning_rules.json next to the scripts (or the file named by environment variable OSM_RULES), so another
+city or region only needs another config file:
+- "region", "cities": elements whose "addr:city" is not one of cities are flagged "not_in_<region>";
+- "boundary": optional GeoJSON file of the boundary of the region (relative to the config file), elements
+  whose "pos" is outside of it are flagged "not_in_<region>" too, see region.py;
+- "postcode": regular expression searched in every postcode, others are dropped (groups and alternatives are
+  fine, for example "^\\d{5}(-\\d{4})?$" for US ZIP codes);
+- "phone_digits": number of last digits kept in phone numbers;
+- "created": attributes grouped under "created";
+- "problem_chars": tags whose key starts with one of these characters are dropped;
+- "address_prefix": tags whose key starts with it go to "address", dropped if the rest has another ":";
+- "street_type", "expected", "mapping": street types audited and street name parts replaced;
+- "tags": tag key => name of its handler in HANDLERS, for keys needing more than the default handling.
+
+TagRules compiles the rules into a dispatch table of tag key => handler, so data.shape_element() does one
+dictionary lookup per tag instead of a chain of string comparisons. Keys which are not in the config get
+their default handler the first time they are seen. Hits of every handler are counted, and time spent in
+handlers is measured when asked.
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm', rule_stats=True)
+>>> OSM_RULES=beijing_rules.json python data.py
+"""
+from collections import defaultdict
+import json
+import os
+import re
+import time
+import cleaning
+import region
+
+RULES_FILE = os.environ.get("OSM_RULES", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "cleaning_rules.json"))
+
+def _to_str(value):
+    """
+    Turn ascii strings of a json document into byte strings, the type ElementTree gives for ascii values.
+    """
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError: # Keep non ascii strings, such as "上海", as unicode
+            return value
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in value.iteritems())
+    return value
+
+def load_json(filename):
+    """
+    Load a json file with ascii strings as byte strings, same as values of parsed xml files.
+    """
+    with open(filename) as f:
+        return _to_str(json.load(f))
+
+class CleaningRules(object):
+    """
+    Cleaning rules of one region, see module documentation for the config keys.
+
+    Args:
+        param_1(dictionary): config
+        param_2(string): directory of the config file, default current directory
+    """
+    def __init__(self, config, base_dir = "."):
+        self.region = config["region"]
+        self.cities = frozenset(config["cities"])
+        self.postcode_re = re.compile(config["postcode"])
+        self.phone_digits = config["phone_digits"]
+        self.created = config["created"]
+        self.problem_chars = re.compile(config["problem_chars"])
+        self.address_prefix = config["address_prefix"]
+        self.street_type_re = re.compile(config["street_type"], re.IGNORECASE)
+        self.expected = config["expected"]
+        self.mapping = config["mapping"]
+        self.street_normalizer = cleaning.StreetNameNormalizer(self.mapping) # Street names of "street" tags
+        self.tags = config["tags"]
+        for key, name in self.tags.iteritems():
+            if name not in HANDLERS:
+                raise ValueError("Unknown handler {} of tag {}".format(name, key))
+        self.handler_keys = defaultdict(list) # Handler name => tag keys, sorted
+        for key in sorted(self.tags):
+            self.handler_keys[self.tags[key]].append(key)
+        self.outside_flag = "not_in_" + self.region # Flag of elements whose city is not in region
+        self.value_cleaner = cleaning.ValueCleaner(postcode=config["postcode"], cities=self.cities,
+                                                   digits=self.phone_digits)
+        self.boundary = config.get("boundary")
+        self.region_grid = None # region.RegionGrid of the boundary
+        if self.boundary:
+            self.region_grid = region.load_region(os.path.join(base_dir, self.boundary))
+
+    def is_region_city(self, city):
+        """
+        Check whether a city name is one of the region, for example "上海" and "上海市" for Shanghai.
+        """
+        return city in self.cities
+
+    def is_region_pos(self, lat, lon):
+        """
+        Check whether a position is inside the boundary of the region, always True without boundary.
+        """
+        return self.region_grid is None or self.region_grid.contains(lat, lon)
+
+    def keys_of(self, handler):
+        """
+        Get tag keys handled by a given handler in the config.
+        """
+        return self.handler_keys.get(handler, [])
+
+    def address_fields_of(self, handler):
+        """
+        Get "address" fields of tag keys handled by a given handler in the config, for example "postcode".
+        """
+        return [key[len(self.address_prefix):] for key in self.keys_of(handler)]
+
+def load_rules(filename = RULES_FILE):
+    """
+    Load cleaning rules from a json config file.
+
+    Args:
+        param_1(string): config file name, default RULES_FILE
+    Returns:
+        CleaningRules
+    """
+    return CleaningRules(load_json(filename), os.path.dirname(os.path.abspath(filename)))
+
+_rules = {}
+
+def get_rules(filename = RULES_FILE):
+    """
+    Get rules of a config file, loaded only once.
+    """
+    if filename not in _rules:
+        _rules[filename] = load_rules(filename)
+    return _rules[filename]
+
+# Handler factories: given the rules and a tag key, build a function(shaped element, address, tag value)
+def _skip(rules, key):
+    def handle(rst, address, value):
+        pass
+    return handle
+
+def _field(rules, key):
+    def handle(rst, address, value):
+        rst[key] = value
+    return handle
+
+def _address(rules, key):
+    field = key[len(rules.address_prefix):]
+    def handle(rst, address, value):
+        address[field] = value
+    return handle
+
+def _english_name(rules, key):
+    def handle(rst, address, value): # If an English name exists, replace or add "name" using the English name
+        rst['name'] = value
+    return handle
+
+def _street(rules, key):
+    field = key[len(rules.address_prefix):]
+    search = rules.street_type_re.search
+    normalizer = rules.street_normalizer
+    def handle(rst, address, value): # Properly format English street name
+        address[field] = normalizer(value) if search(value) else value
+    return handle
+
+HANDLERS = {"field": _field, # Tag is copied as it is
+            "address": _address, # Tag goes to "address" without the prefix
+            "problem_key": _skip, # Key starts with a problem character
+            "nested_address": _skip, # No two ":" allowed in address keys
+            "skip": _skip,
+            "english_name": _english_name,
+            "street": _street,
+            "phone": _field, # Raw values, formatted and filtered by data.clean_elements()
+            "postcode": _address,
+            "city": _address}
+
+class TagRules(object):
+    """
+    Dispatch table of tag key => (handler name, handler) built from CleaningRules.
+    """
+    def __init__(self, rules, timed = False):
+        self.rules = rules
+        self.timed = timed
+        self.table = {}
+        self.hits = defaultdict(int)
+        self.seconds = defaultdict(float)
+        for key in rules.tags:
+            self.table[key] = self.compile(key)
+
+    def compile(self, key):
+        """
+        Choose the handler of a tag key, in the order of the old if/elif chain of data.shape_element().
+        """
+        rules = self.rules
+        if rules.problem_chars.match(key):
+            name = "problem_key"
+        elif key in rules.tags:
+            name = rules.tags[key]
+        elif key.startswith(rules.address_prefix):
+            name = "nested_address" if ":" in key[len(rules.address_prefix):] else "address"
+        else:
+            name = "field"
+        return name, HANDLERS[name](rules, key)
+
+    def apply(self, rst, address, key, value):
+        """
+        Handle one tag of an element being shaped.
+
+        Args:
+            param_1(dictionary): shaped element
+            param_2(dictionary): its address
+            param_3(string): tag key
+            param_4(string): tag value
+        Returns:
+            None
+        """
+        entry = self.table.get(key)
+        if entry is None:
+            entry = self.table[key] = self.compile(key)
+        name, handle = entry
+        if self.timed:
+            start = time.time()
+            handle(rst, address, value)
+            self.seconds[name] += time.time() - start
+        else:
+            handle(rst, address, value)
+        self.hits[name] += 1
+
+    def handler_name(self, key):
+        """
+        Get the name of the handler of a tag key, as apply() would choose it.
+        """
+        entry = self.table.get(key)
+        if entry is None:
+            entry = self.table[key] = self.compile(key)
+        return entry[0]
+
+    def count(self, names):
+        """
+        Count hits of handlers of tags which were not applied, as data.is_uninformative() decided the element
+        is not written whatever they do.
+        """
+        for name in names:
+            self.hits[name] += 1
+
+    def reset(self):
+        self.hits.clear()
+        self.seconds.clear()
+
+    def report(self):
+        """
+        Returns:
+            dictionary: Keys are handler names, values are {"hits": number of tags, "seconds": time spent,
+                        0 unless timed}
+        """
+        return dict((name, {"hits": hits, "seconds": self.seconds.get(name, 0.0)})
+                    for name, hits in self.hits.iteritems())
+
+def merge_reports(reports):
+    """
+    Merge reports of TagRules.report(), for example from worker processes.
+    """
+    rst = {}
+    for report in reports:
+        for name, stats in report.iteritems():
+            total = rst.setdefault(name, {"hits": 0, "seconds": 0.0})
+            total["hits"] += stats["hits"]
+            total["seconds"] += stats["seconds"]
+    return rst
+
+def print_report(report):
+    for name, stats in sorted(report.iteritems(), key=lambda item: -item[1]["hits"]):
+        print "=========Rule {}: {} hits, {:.3f} s".format(name, stats["hits"], stats["seconds"])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+sketch.py contains small fixed size summaries of big streams of values, used when counting exact distinct
+values of a whole extract would need too much memory.
+
+Usage:
+>>> import sketch
+>>> hll = sketch.HyperLogLog()
+>>> for value in ['a', 'b', 'a']:
+...     hll.add(value)
+>>> hll.count()
+2
+"""
+import base64
+import hashlib
+import math
+import struct
+
+DISTINCT_LIMIT = 10000 # Values counted exactly by DistinctCounter before it switches to a HyperLogLog
+
+class HyperLogLog(object):
+    """
+    HyperLogLog distinct counter. Each add() is O(1), memory is 2^precision bytes whatever the number of values,
+    and the standard error of count() is about 1.04 / sqrt(2^precision) (3% for default precision 10).
+    Sketches with same precision can be merged, for example counters built by different worker processes.
+    """
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        """
+        Add a string value to the sketch.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        x = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0] # md5 keeps sketches comparable between processes
+        index = x & (self.size - 1)
+        rank = 64 - self.precision - (x >> self.precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merge another sketch of same precision into this one.
+        """
+        for i in range(self.size):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+
+    def count(self):
+        """
+        Returns:
+            int: estimated number of distinct values added
+        """
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * m and zeros != 0: # Small range correction
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(str(self.registers))}
+
+    @classmethod
+    def from_dict(cls, state):
+        hll = cls(state["precision"])
+        hll.registers = bytearray(base64.b64decode(state["registers"]))
+        return hll
+
+class DistinctCounter(object):
+    """
+    Distinct counter keeping the values themselves until there are more than limit of them, then a HyperLogLog,
+    so small counts are exact (and the values can be listed) and memory stays bounded for big ones.
+    """
+    def __init__(self, limit=DISTINCT_LIMIT, precision=14):
+        self.limit = limit
+        self.values = set() # None once switched to the sketch
+        self.hll = HyperLogLog(precision)
+
+    def is_exact(self):
+        return self.values is not None
+
+    def _to_sketch(self):
+        for value in self.values:
+            self.hll.add(value)
+        self.values = None
+
+    def add(self, value):
+        if self.values is None:
+            self.hll.add(value)
+        else:
+            self.values.add(value)
+            if len(self.values) > self.limit:
+                self._to_sketch()
+
+    def merge(self, other):
+        """
+        Merge another counter of same precision into this one.
+        """
+        if other.values is not None:
+            for value in other.values:
+                self.add(value)
+        else:
+            if self.values is not None:
+                self._to_sketch()
+            self.hll.merge(other.hll)
+
+    def count(self):
+        return len(self.values) if self.values is not None else self.hll.count()
+
+    def to_dict(self):
+        """
+        Returns:
+            dictionary: state which can be saved as json and given to from_dict()
+        """
+        if self.values is not None:
+            return {"limit": self.limit, "precision": self.hll.precision, "values": sorted(self.values)}
+        return {"limit": self.limit, "precision": self.hll.precision, "hll": self.hll.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        counter = cls(state["limit"], state["precision"])
+        if "values" in state:
+            counter.values = set(state["values"])
+        else:
+            counter.values = None
+            counter.hll = HyperLogLog.from_dict(state["hll"])
+        return counter
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+spatial.py answers spatial questions on converted data, such as "amenities within X metres of a point",
+"everything in this bounding box" or "k nearest restaurants", with two interchangeable backends:
+
+- MongoSpatial runs queries on the loaded collection, using the 2d index on "pos" (see mongoindex.py);
+- GridIndex is an in-process grid built from the json output of data.py, for offline use without mongodb.
+
+Both backends have the same methods and return the same documents. Distances are great circle distances
+in metres. "pos" is [latitude, longitude] as built by data.shape_element().
+
+Usage:
+>>> python spatial.py
+"""
+from array import array
+from collections import defaultdict
+import json
+import math
+import random
+import time
+import compression
+
+EARTH_RADIUS = 6371008.8 # Mean earth radius in metres
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+CELL_SIZE = 0.01 # Grid cell size in degrees, about 1 km in Shanghai
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in metres between two points given in degrees.
+    """
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def radius_bbox(lat, lon, radius):
+    """
+    Smallest bounding box (min_lat, min_lon, max_lat, max_lon) containing a circle of radius metres.
+    """
+    dlat = radius / METRES_PER_DEGREE
+    angle = radius / EARTH_RADIUS
+    if angle >= math.pi / 2 or abs(lat) + dlat >= 90: # Circle too large or around a pole, take all longitudes
+        return lat - dlat, -180.0, lat + dlat, 180.0
+    dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+def match_amenity(doc, amenity):
+    """
+    Check a document against the amenity filter of queries: None matches all documents,
+    True matches documents having any amenity, a string matches documents of this amenity.
+    """
+    if amenity is None:
+        return True
+    if amenity is True:
+        return "amenity" in doc
+    return doc.get("amenity") == amenity
+
+def nearest_by_radius(backend, lat, lon, k, amenity, candidates):
+    """
+    Exact k nearest documents, given at least k candidates close to the point (or all documents if fewer):
+    the k true nearest documents are all within the distance of the k-th closest candidate.
+    """
+    if len(candidates) == 0:
+        return []
+    dists = sorted(haversine(lat, lon, doc["pos"][0], doc["pos"][1]) for doc in candidates)
+    found = backend.within(lat, lon, dists[min(k, len(dists)) - 1], amenity)
+    found.sort(key=lambda doc: haversine(lat, lon, doc["pos"][0], doc["pos"][1]))
+    return found[:k]
+
+class GridIndex(object):
+    """
+    In-process spatial index: documents having a "pos" are put into square cells of CELL_SIZE degrees,
+    positions are kept in compact float arrays. A query only looks at cells overlapping its bounding box.
+    """
+    def __init__(self, docs, cell_size = CELL_SIZE):
+        self.cell_size = cell_size
+        self.docs = []
+        self.lats = array('d')
+        self.lons = array('d')
+        self.cells = defaultdict(lambda: array('l'))
+        for doc in docs:
+            if "pos" not in doc:
+                continue
+            lat, lon = doc["pos"]
+            self.cells[self.cell(lat, lon)].append(len(self.docs))
+            self.docs.append(doc)
+            self.lats.append(lat)
+            self.lons.append(lon)
+        self.cells = dict(self.cells)
+        keys = self.cells.keys() or [(0, 0)]
+        self.cell_range = (min(i for i, _ in keys), min(j for _, j in keys),
+                           max(i for i, _ in keys), max(j for _, j in keys))
+
+    @classmethod
+    def from_json(cls, file_in, cell_size = CELL_SIZE):
+        """
+        Build index from json output of data.process_map(), one document per line, which may be compressed.
+        """
+        with compression.open_input(file_in) as f:
+            return cls((json.loads(line) for line in f), cell_size)
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def _bbox_ids(self, min_lat, min_lon, max_lat, max_lon):
+        min_i, min_j = self.cell(min_lat, min_lon)
+        max_i, max_j = self.cell(max_lat, max_lon)
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self.cells): # Box larger than data, look at all cells
+            keys = [key for key in self.cells if min_i <= key[0] <= max_i and min_j <= key[1] <= max_j]
+        else:
+            keys = [(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1) if (i, j) in self.cells]
+        for key in keys:
+            for n in self.cells[key]:
+                if min_lat <= self.lats[n] <= max_lat and min_lon <= self.lons[n] <= max_lon:
+                    yield n
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, amenity = None):
+        """
+        Documents inside a bounding box given in degrees.
+        """
+        return [self.docs[n] for n in self._bbox_ids(min_lat, min_lon, max_lat, max_lon)
+                if match_amenity(self.docs[n], amenity)]
+
+    def within(self, lat, lon, radius, amenity = None):
+        """
+        Documents within radius metres of a point.
+        """
+        return [self.docs[n] for n in self._bbox_ids(*radius_bbox(lat, lon, radius))
+                if haversine(lat, lon, self.lats[n], self.lons[n]) <= radius and match_amenity(self.docs[n], amenity)]
+
+    def nearest(self, lat, lon, k, amenity = None):
+        """
+        k nearest documents of a point, closest first.
+        """
+        ci, cj = self.cell(lat, lon)
+        min_i, min_j, max_i, max_j = self.cell_range
+        max_ring = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj) # Beyond this ring there is no cell
+        candidates = []
+        ring = 0
+        while len(candidates) < k and ring <= max_ring: # Grow a square of cells until it holds k documents
+            if (2 * ring + 1) ** 2 > len(self.cells): # Far from data, cheaper to take all documents
+                candidates = [doc for doc in self.docs if match_amenity(doc, amenity)]
+                break
+            for i in range(ci - ring, ci + ring + 1):
+                for j in range(cj - ring, cj + ring + 1):
+                    if max(abs(i - ci), abs(j - cj)) == ring and (i, j) in self.cells:
+                        candidates.extend(self.docs[n] for n in self.cells[(i, j)]
+                                          if match_amenity(self.docs[n], amenity))
+            ring += 1
+        return nearest_by_radius(self, lat, lon, k, amenity, candidates)
+
+class MongoSpatial(object):
+    """
+    Same queries as GridIndex on a mongodb collection with the 2d index of mongoindex.py on "pos".
+    The 2d index works on flat [latitude, longitude] coordinates, so circles are looked up by their bounding
+    box and refined with great circle distances, and nearest documents by flat distance then refined the same way.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _query(self, geo, amenity):
+        query = {"pos": geo}
+        if amenity is True:
+            query["amenity"] = {"$exists": True}
+        elif amenity is not None:
+            query["amenity"] = amenity
+        return query
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, amenity = None):
+        geo = {"$geoWithin": {"$box": [[min_lat, min_lon], [max_lat, max_lon]]}}
+        return list(self.collection.find(self._query(geo, amenity), {"_id": 0}))
+
+    def within(self, lat, lon, radius, amenity = None):
+        return [doc for doc in self.bbox(*radius_bbox(lat, lon, radius), amenity=amenity)
+                if haversine(lat, lon, doc["pos"][0], doc["pos"][1]) <= radius]
+
+    def nearest(self, lat, lon, k, amenity = None):
+        candidates = list(self.collection.find(self._query({"$near": [lat, lon]}, amenity), {"_id": 0}).limit(k))
+        return nearest_by_radius(self, lat, lon, k, amenity, candidates)
+
+def benchmark(backends, points, radius = 500, k = 10, amenity = True):
+    """
+    Compare query latency of backends on the same points.
+
+    Args:
+        param_1(dictionary): Keys are backend names, values are GridIndex or MongoSpatial
+        param_2(list): (latitude, longitude) query points
+        param_3(float): radius in metres for within() and half size of box for bbox(), default 500
+        param_4(int): number of documents for nearest(), default 10
+        param_5: amenity filter of queries, default True (any amenity)
+    Returns:
+        dictionary: Keys are (backend name, query name), values are average latency in milliseconds
+    """
+    rst = {}
+    for name, backend in sorted(backends.items()):
+        queries = [("bbox", lambda lat, lon: backend.bbox(*radius_bbox(lat, lon, radius), amenity=amenity)),
+                   ("within", lambda lat, lon: backend.within(lat, lon, radius, amenity)),
+                   ("nearest", lambda lat, lon: backend.nearest(lat, lon, k, amenity))]
+        for query, run in queries:
+            start = time.time()
+            for lat, lon in points:
+                run(lat, lon)
+            rst[(name, query)] = (time.time() - start) * 1000 / max(len(points), 1)
+            print "{:>8} {:>8}: {:.3f} ms".format(name, query, rst[(name, query)])
+    return rst
+
+def test():
+    grid = GridIndex.from_json('shanghai_china.osm.json')
+    random.seed(0)
+    points = [(grid.lats[n], grid.lons[n]) for n in random.sample(range(len(grid.docs)), min(100, len(grid.docs)))]
+    backends = {"grid": grid}
+    try:
+        import mongoload
+        backends["mongodb"] = MongoSpatial(mongoload.get_client('localhost:27017')['openStreetMap']['shanghai'])
+    except ImportError: # pymongo not installed, compare only offline backend
+        pass
+    benchmark(backends, points)
+
+if __name__ == "__main__":
+    test()
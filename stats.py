@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+stats.py keeps the summary numbers of import_mongodb_and_query.py up to date while data.process_map() writes
+documents: total records, distinct users, nodes and ways, distinct postcodes and phone numbers, top amenities and
+the number of amenities by frequency. They are saved to "<input>.stats.json" (and by mongoload.load_map() to the
+"stats" collection), so the report is read from there instead of scanning the whole collection.
+
+Distinct values are counted exactly up to sketch.DISTINCT_LIMIT of them, then estimated with a HyperLogLog.
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm', with_stats=True)  # Saves shanghai_china.osm.stats.json
+"""
+from collections import defaultdict
+import json
+import rules
+import sketch
+
+TOP_AMENITIES = 3
+STATS_COLLECTION = "stats"
+
+class SummaryStats(object):
+    """
+    Rollups of written documents, updated one document at a time. Rollups of shards can be merged.
+    """
+    def __init__(self, limit = sketch.DISTINCT_LIMIT):
+        cleaning_rules = rules.get_rules()
+        self.phone_keys = cleaning_rules.keys_of("phone")
+        self.postcode_fields = cleaning_rules.address_fields_of("postcode")
+        self.records = 0
+        self.types = defaultdict(int)
+        self.users = sketch.DistinctCounter(limit)
+        self.postcodes = sketch.DistinctCounter(limit)
+        self.phones = sketch.DistinctCounter(limit)
+        self.amenities = defaultdict(int) # Amenity => number of documents, None for documents without amenity
+
+    def add(self, el):
+        """
+        Count one shaped document, as written to the output.
+        """
+        self.records += 1
+        self.types[el.get('type')] += 1
+        user = el.get('created', {}).get('user')
+        if user is not None:
+            self.users.add(user)
+        for key in self.phone_keys:
+            if key in el:
+                self.phones.add(el[key])
+        address = el.get('address')
+        if address:
+            for field in self.postcode_fields:
+                if field in address:
+                    self.postcodes.add(address[field])
+        self.amenities[el.get('amenity')] += 1
+
+    def merge(self, other):
+        self.records += other.records
+        for el_type, count in other.types.iteritems():
+            self.types[el_type] += count
+        self.users.merge(other.users)
+        self.postcodes.merge(other.postcodes)
+        self.phones.merge(other.phones)
+        for amenity, count in other.amenities.iteritems():
+            self.amenities[amenity] += count
+
+    def to_dict(self):
+        """
+        Returns:
+            dictionary: state which can be saved as json (for example in a checkpoint) and given to from_dict()
+        """
+        return {"records": self.records, "types": dict(self.types), "users": self.users.to_dict(),
+                "postcodes": self.postcodes.to_dict(), "phones": self.phones.to_dict(),
+                "amenities": [[amenity, count] for amenity, count in self.amenities.iteritems()]}
+
+    @classmethod
+    def from_dict(cls, state):
+        summary = cls()
+        summary.records = state["records"]
+        summary.types.update(state["types"])
+        summary.users = sketch.DistinctCounter.from_dict(state["users"])
+        summary.postcodes = sketch.DistinctCounter.from_dict(state["postcodes"])
+        summary.phones = sketch.DistinctCounter.from_dict(state["phones"])
+        summary.amenities.update((amenity, count) for amenity, count in state["amenities"])
+        return summary
+
+    def report(self):
+        """
+        Returns:
+            dictionary: "records", "users", "nodes", "ways", "postcodes" and "phones" (numbers of distinct values,
+                        "postcode_values" and "phone_values" list them when counted exactly, None otherwise),
+                        "exact" => whether distinct counts are exact,
+                        "amenity_top" => TOP_AMENITIES most frequent amenities as {"_id", "count"},
+                        "amenity_frequency" => [{"_id": number of documents, "num_amenity": number of amenities}]
+                        sorted by number of documents, documents without amenity are one group as in $group.
+        """
+        frequency = defaultdict(int)
+        for count in self.amenities.itervalues():
+            frequency[count] += 1
+        top = sorted(((amenity, count) for amenity, count in self.amenities.iteritems() if amenity is not None),
+                     key=lambda item: (-item[1], item[0]))[:TOP_AMENITIES]
+        return {"records": self.records,
+                "users": self.users.count(),
+                "nodes": self.types.get('node', 0),
+                "ways": self.types.get('way', 0),
+                "postcodes": self.postcodes.count(),
+                "postcode_values": sorted(self.postcodes.values) if self.postcodes.is_exact() else None,
+                "phones": self.phones.count(),
+                "phone_values": sorted(self.phones.values) if self.phones.is_exact() else None,
+                "exact": self.users.is_exact() and self.postcodes.is_exact() and self.phones.is_exact(),
+                "amenity_top": [{"_id": amenity, "count": count} for amenity, count in top],
+                "amenity_frequency": [{"_id": count, "num_amenity": num} for count, num in sorted(frequency.items())]}
+
+def write_report(report, file_out):
+    with open(file_out, "w") as fo:
+        fo.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+def load_report(file_in):
+    with open(file_in) as f:
+        return json.load(f)
+
+def save_to_collection(report, db, collection):
+    """
+    Save a report as the document of a collection in the STATS_COLLECTION of its database.
+    """
+    db[STATS_COLLECTION].replace_one({"_id": collection}, dict(report, _id=collection), upsert=True)
+
+def load_from_collection(db, collection):
+    """
+    Get the report of a collection saved by save_to_collection(), None if there is none.
+    """
+    return db[STATS_COLLECTION].find_one({"_id": collection})
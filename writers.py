@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+writers.py contains the output formats of data.process_map(). Every writer has the same write(el) and close()
+methods (like mongoload.BulkWriter), gathers shaped elements into batches, encodes a whole batch at once
+and counts bytes written and time spent encoding, so formats can be compared.
+
+Formats (see FORMATS):
+- "json": one json document per line (or pretty printed), for mongoimport;
+- "bson": stream of BSON documents, for mongorestore (needs bson module of pymongo);
+- "msgpack": stream of MessagePack documents (needs msgpack);
+- "parquet": columnar Parquet files of nodes and ways, for analytics (needs pyarrow).
+Output file names ending with a compression suffix of compression.py are compressed while they are written;
+Parquet files use the matching codec of Parquet instead (".gz" or ".zst").
+
+Usage:
+>>> import data
+>>> data.process_map('shanghai_china.osm', output_format='bson')
+"""
+import json
+import os
+import time
+import compression
+try:
+    from bson import encode as bson_encode
+except ImportError:
+    try:
+        from bson import BSON # pymongo before 3.9
+        bson_encode = BSON.encode
+    except ImportError: # pymongo is not installed
+        bson_encode = None
+try:
+    import msgpack
+except ImportError: # msgpack format is optional
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # parquet format is optional
+    pyarrow = None
+
+BATCH_SIZE = 1000 # Number of documents encoded at once
+
+class BatchWriter(object):
+    """
+    Base class of writers: subclasses only define encode_batch() which turns a list of shaped elements into bytes.
+    """
+    def __init__(self, file_out, batch_size = BATCH_SIZE, resume_offset = None):
+        if resume_offset is None:
+            self.fo = compression.open_output(file_out)
+            self.bytes_written = 0
+        else: # Continue a file of data.process_map_checkpointed(), without what was written after the checkpoint
+            self.fo = open(file_out, "r+b")
+            self.fo.truncate(resume_offset)
+            self.fo.seek(resume_offset)
+            self.bytes_written = resume_offset
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        self.encode_time = 0.0
+
+    def write(self, el):
+        self.batch.append(el)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        start = time.time()
+        data = self.encode_batch(self.batch)
+        self.encode_time += time.time() - start
+        self.fo.write(data)
+        self.bytes_written += len(data)
+        self.count += len(self.batch)
+        self.batch = []
+
+    def checkpoint(self):
+        """
+        Write pending documents through to disk.
+
+        Returns:
+            int: size of the file, where writing can be resumed
+        """
+        self.flush()
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+        return self.fo.tell()
+
+    def close(self):
+        self.flush()
+        self.fo.close()
+
+class JsonWriter(BatchWriter):
+    """
+    One json document per line, or pretty printed documents.
+    """
+    def __init__(self, file_out, pretty = False, batch_size = BATCH_SIZE, resume_offset = None):
+        BatchWriter.__init__(self, file_out, batch_size, resume_offset)
+        self.pretty = pretty
+
+    def encode_batch(self, batch):
+        if self.pretty:
+            return "".join(json.dumps(el, indent=2) + "\n" for el in batch)
+        return "".join(json.dumps(el) + "\n" for el in batch)
+
+class BsonWriter(BatchWriter):
+    """
+    Concatenated BSON documents, the format of mongodump files, which mongorestore loads directly.
+    """
+    def __init__(self, file_out, batch_size = BATCH_SIZE, resume_offset = None):
+        if bson_encode is None:
+            raise ImportError("bson module of pymongo is needed for bson output")
+        BatchWriter.__init__(self, file_out, batch_size, resume_offset)
+
+    def encode_batch(self, batch):
+        return "".join(bson_encode(el) for el in batch)
+
+class MsgpackWriter(BatchWriter):
+    """
+    Concatenated MessagePack documents, read back with msgpack.Unpacker.
+    """
+    def __init__(self, file_out, batch_size = BATCH_SIZE, resume_offset = None):
+        if msgpack is None:
+            raise ImportError("msgpack is needed for msgpack output")
+        BatchWriter.__init__(self, file_out, batch_size, resume_offset)
+        self.packer = msgpack.Packer(use_bin_type=True)
+
+    def encode_batch(self, batch):
+        return "".join(self.packer.pack(el) for el in batch)
+
+PARQUET_COLUMNS = ["id", "version", "changeset", "timestamp", "user", "uid"] # Always there, from "created"
+PARQUET_CODECS = {None: "snappy", ".gz": "gzip", ".zst": "zstd"} # Compression suffix => Parquet codec
+
+class ParquetWriter(object):
+    """
+    Columnar dump: nodes go to "<output>.nodes.parquet" with "lat" and "lon" columns, ways to
+    "<output>.ways.parquet" with a "node_refs" list column. Both have id, created fields, and all other
+    fields (tags, address) as a json "tags" column. Each batch is written as a row group.
+    """
+    def __init__(self, file_out, batch_size = BATCH_SIZE * 10):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed for parquet output")
+        suffix = compression.compression_suffix(file_out)
+        if suffix not in PARQUET_CODECS:
+            raise ValueError("Parquet files cannot be compressed with {}".format(suffix))
+        self.codec = PARQUET_CODECS[suffix]
+        self.file_out = compression.strip_suffix(file_out)
+        self.batch_size = batch_size
+        self.batches = {"node": [], "way": []}
+        self.files = {}
+        self.count = 0
+        self.bytes_written = 0
+        self.encode_time = 0.0
+
+    def write(self, el):
+        batch = self.batches[el["type"]]
+        batch.append(el)
+        if len(batch) >= self.batch_size:
+            self.flush(el["type"])
+
+    def columns(self, el_type, batch):
+        created = [el.get("created", {}) for el in batch]
+        cols = {"id": [el["id"] for el in batch]}
+        for name in PARQUET_COLUMNS[1:]:
+            cols[name] = [c.get(name) for c in created]
+        skip = set(["id", "type", "created", "pos", "node_refs"])
+        cols["tags"] = [json.dumps(dict((k, v) for k, v in el.iteritems() if k not in skip)) for el in batch]
+        if el_type == "node":
+            cols["lat"] = [el["pos"][0] if "pos" in el else None for el in batch]
+            cols["lon"] = [el["pos"][1] if "pos" in el else None for el in batch]
+        else:
+            cols["node_refs"] = [el.get("node_refs", []) for el in batch]
+        return cols
+
+    def schema(self, el_type):
+        fields = [(name, pyarrow.string()) for name in PARQUET_COLUMNS + ["tags"]]
+        if el_type == "node":
+            fields += [("lat", pyarrow.float64()), ("lon", pyarrow.float64())]
+        else:
+            fields += [("node_refs", pyarrow.list_(pyarrow.string()))]
+        return pyarrow.schema(fields)
+
+    def flush(self, el_type):
+        batch = self.batches[el_type]
+        if len(batch) == 0:
+            return
+        start = time.time()
+        table = pyarrow.Table.from_pydict(self.columns(el_type, batch), self.schema(el_type))
+        if el_type not in self.files:
+            name = "{0}.{1}s.parquet".format(self.file_out, el_type)
+            self.files[el_type] = (name, pyarrow.parquet.ParquetWriter(name, table.schema,
+                                                                                compression=self.codec))
+        self.files[el_type][1].write_table(table)
+        self.encode_time += time.time() - start
+        self.count += len(batch)
+        self.batches[el_type] = []
+
+    def close(self):
+        for el_type in self.batches:
+            self.flush(el_type)
+        for name, writer in self.files.values():
+            writer.close()
+            self.bytes_written += os.path.getsize(name)
+
+FORMATS = {"json": JsonWriter, "bson": BsonWriter, "msgpack": MsgpackWriter, "parquet": ParquetWriter}
+EXTENSIONS = {"json": ".json", "bson": ".bson", "msgpack": ".msgpack", "parquet": ""} # Added to input file name
+CONCATENABLE = ["json", "bson", "msgpack"] # Formats whose part files can be merged by appending them
+
+def open_writer(output_format, file_out, pretty = False, resume_offset = None):
+    """
+    Create a writer of one of FORMATS, pretty only applies to json. Writers of CONCATENABLE formats can continue
+    an existing file from a given offset (resume_offset), which truncates it there.
+    """
+    if resume_offset is not None:
+        if output_format not in CONCATENABLE:
+            raise ValueError("{} output cannot be resumed".format(output_format))
+        if output_format == "json":
+            return JsonWriter(file_out, pretty, resume_offset=resume_offset)
+        return FORMATS[output_format](file_out, resume_offset=resume_offset)
+    if output_format == "json":
+        return JsonWriter(file_out, pretty)
+    return FORMATS[output_format](file_out)